@@ -12,10 +12,20 @@ import queue
 import time
 import threading
 import tkinter.messagebox
-import json
+import os
 
 from main import runStartup
+from main import stopService
 from main import pageRequestFlag
+from main import wakeService
+from main import startWorkers
+from main import openAnalytics
+from viewmodel import ClientViewModel
+from pager_list import PagerList
+from gui_tasks import TaskQueue
+from photos import PhotoCache
+from report import REPORT_DIR
+from profiling import WATCHDOG, install_signals
 
 DEBUG_GUI = False
 
@@ -23,22 +33,37 @@ DEBUG_GUI = False
 DEFAULT_BUTTON_COLOR = 'gray'
 RESPONSE_TIME_MS = 5000
 
+#Each frame runs queued GUI tasks, most important first, then redraws badge
+#buttons from the view model, spending at most GUI_FRAME_BUDGET_MS between
+#them. Frames only run when the service signals new work, by writing a byte to
+#a pipe Tk watches; whatever doesn't fit waits GUI_FRAME_MS for the next frame.
+#The service thread never calls into Tk, so a busy GUI can't hold up paging.
+#Where Tk can't watch a pipe (Windows), or a wake goes missing, a poll every
+#GUI_POLL_MS picks the work up instead.
+GUI_FRAME_MS = 100
+GUI_FRAME_BUDGET_MS = 25
+GUI_RENDER_CHUNK = 32 #Changes taken from the view model at a time
+GUI_POLL_MS = 500 #Fallback poll, GUI_FRAME_MS when there is no wake pipe
+
+STATUS_COLORS = {
+    'active': 'green',
+    'inactive': 'orange',
+    'offline': 'red',
+}
+
 #Define font sizes
 FONT_SIZE_TITLE = 48
 FONT_SIZE_TEXT = 24
 FONT_SIZE_SUBTEXT = 18
 
 class ClientGUI:
-    def __init__(self):
+    def __init__(self, analytics):
         #Initial GUI Setup
         self.root = tk.Tk()
         self.root.title("Patron Handler Service v1.0")
         self.root.config(bg="skyblue")
         self.root.maxsize(1200,1000)
 
-        #Define array to contain all of the registered pagers
-        self.buttons = {}
-
         #==============================================
         ##### LEFT FRAME - PAGER LIST AND REQUEST #####
         #==============================================
@@ -53,15 +78,16 @@ class ClientGUI:
         self.response_label_number = tk.Label(self.left_frame, text = "Total Responses: 0", font=("default", FONT_SIZE_SUBTEXT))
         self.response_label_number.grid(row=1, column=0, padx=5, pady=5)
 
-        # Button Container - Pager List
-        self.button_frame = tk.Frame(self.left_frame)
-        self.button_frame.grid(row=2, column=0, padx=10, pady=5)
+        # Button Container - Pager List, one row per registered pager
+        self.pager_list = PagerList(self.left_frame, self.click_client, ("default", FONT_SIZE_TEXT), colors=STATUS_COLORS)
+        self.pager_list.grid(row=2, column=0, padx=10, pady=5)
 
         # "No Help Available" - Don't show initially, call .grid() again to show
         self.response_label = tk.Label(self.left_frame, text="NO HELP AVAILABLE", font=("default", FONT_SIZE_TEXT))
         self.response_label.grid(row=3, column=0, padx=5, pady=5)
         self.response_label.grid_remove()
         self.displayingResponse = False
+        self._responseTimer = None #Hides the response showing, see response_disp
 
         # Pager request button
         self.pager_button = tk.Button(self.left_frame, text="Send Pager Request", command=self.send_pager_request, font=("default", FONT_SIZE_TEXT))
@@ -77,10 +103,10 @@ class ClientGUI:
         tk.Label(self.right_frame, text="Staff Details",font=("default", FONT_SIZE_TITLE)).grid(row=0,column=0,padx=5,pady=5)
 
         
+        # Staff photo, the one label is reused for every badge clicked
         self.tech_info_image = tk.Label(self.right_frame, width = 20, height = 20, bg='grey')
         self.tech_info_image.grid(row=1, column=0, padx=10, pady=5)
-        self.image = tk.PhotoImage(file="Enoch.png")
-        self.imageToDisplay = self.image.subsample(20,20)
+        self.photos = PhotoCache()
 
         self.tech_info_frame = tk.Frame(self.right_frame, bg='grey')
         self.tech_info_frame.grid(row=2,column=0,padx=5,pady=5)
@@ -95,102 +121,155 @@ class ClientGUI:
         self.tech_info_label_position_response = tk.Label(self.tech_info_frame, text="", font=("default", FONT_SIZE_TEXT))
         self.tech_info_label_position_response.grid(row=1,column=1,padx=2,pady=2)
 
-        # Create a queue for tasks
-        self.queue = queue.Queue()
+        # Latest staff meeting report, written by report.py outside the service
+        self.report_button = tk.Button(self.right_frame, text="Show Report", command=self.show_report, font=("default", FONT_SIZE_SUBTEXT))
+        self.report_button.grid(row=3,column=0,padx=5,pady=5)
+
+        # Create a queue for tasks, see gui_tasks.py for priorities
+        self.queue = TaskQueue(self._signal_work)
         self.server_message_queue = queue.Queue()
 
+        # What each badge's button should look like, filled in by the service
+        self.view = ClientViewModel(self._signal_work)
+
+        # The service wakes the Tk thread through a pipe instead of polling
+        self._wakePending = False
+        self._frameTimer = None
+        self._wakeRead, self._wakeWrite = os.pipe()
+        os.set_blocking(self._wakeRead, False)
+        os.set_blocking(self._wakeWrite, False)
+        try:
+            self.root.tk.createfilehandler(self._wakeRead, tk.READABLE, self._woken)
+            self._pollMs = GUI_POLL_MS
+        except (AttributeError, tk.TclError):
+            #No file handlers in this Tk, polling it is
+            self._pollMs = GUI_FRAME_MS
+
         self.isPaging = False
 
-        self.analytics_file = "analytics.txt"
-        # Read the current values from the file
-        with open(self.analytics_file, 'r') as file:
-            data = json.load(file)
+        # Counters come from the page events the service logs, see analytics.py
+        self.analytics = analytics
+        self.refresh_response_count()
+
+    #_signal_work
+    #Called from the service thread when GUI work is queued. Writes at most one
+    #wake byte until the GUI has looked at the queue again, and never waits on
+    #Tk: if the pipe is full a wake is already on its way.
+    def _signal_work(self):
+        if self._wakePending:
+            return
+        self._wakePending = True
+        WATCHDOG.pending("gui")
+        try:
+            os.write(self._wakeWrite, b'w')
+        except OSError:
+            pass #Full, or the GUI is gone. The poll covers it either way.
+
+    def _woken(self, fd, mask):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.check_queue()
 
-        # Update the response_label_number visual
-        self.response_label_number.config(text=f"Total Responses: {str(data['responses'])}")
+    def _poll(self):
+        self.root.after(self._pollMs, self._poll)
+        if self._wakePending:
+            self.check_queue()
 
-        # Start checking the queue for new tasks
+    def _frame_due(self):
+        self._frameTimer = None
         self.check_queue()
 
     def check_queue(self):
-        while not self.queue.empty():
-            if DEBUG_GUI:
-                print("GUI -- executing GUI task")
-            task = self.queue.get()
-            task()
-        self.root.after(100, self.check_queue)
+        #The watchdog clock has been running since the work was posted
+        WATCHDOG.pending("gui")
+        #Cleared first so work queued from here on signals again
+        self._wakePending = False
+
+        start = time.perf_counter()
+        ran = self.queue.run(GUI_FRAME_BUDGET_MS)
+        if DEBUG_GUI and ran:
+            print(f"GUI -- ran {ran} GUI tasks, {len(self.queue)} left")
+
+        spent = (time.perf_counter() - start) * 1000
+        self._render_view(GUI_FRAME_BUDGET_MS - spent)
+
+        #Out of budget, pick up the rest next frame
+        if (len(self.queue) or self.view.pending()) and self._frameTimer is None:
+            self._frameTimer = self.root.after(GUI_FRAME_MS, self._frame_due)
+        WATCHDOG.leave("gui")
+
+        #Work left for the next frame, or posted while this one ran
+        if self._wakePending or self._frameTimer is not None:
+            WATCHDOG.pending("gui")
+
+    # Bring the badge buttons in line with the view model, only touching the
+    # ones that changed and stopping once budget_ms is spent
+    def _render_view(self, budget_ms):
+        start = time.perf_counter()
+        while ((time.perf_counter() - start) * 1000) < budget_ms:
+            changes = self.view.changes(GUI_RENDER_CHUNK)
+            if not changes:
+                break
+            for client_id, view in changes:
+                if view is None:
+                    self.pager_list.remove(client_id)
+                elif client_id in self.pager_list:
+                    self.pager_list.update(client_id, view)
+                else:
+                    self.pager_list.insert(client_id, view)
+
+        if DEBUG_GUI and self.view.pending():
+            print(f"GUI -- {self.view.pending()} badge updates left for the next frame")
 
     def update_status(self, client_props, status):
-        #if the button doesn't exist, add it
-        if client_props["i"] not in self.buttons or self.buttons[client_props["i"]] is None:
-            if status == 'active':
-                self.queue.put(lambda: self._add_client(client_props))
-                return
-
-        # Determine the button color based on the status
-        if status == 'active':
-            color = 'green'
-        elif status == 'inactive':
-            color = 'orange'
-        else:  # status is 'offline'
-            color = 'red'
-
-        if (self.buttons[client_props["i"]]):
-            button = self.buttons[client_props["i"]]
-            button.config(bg=color)
+        self.view.update(client_props, status)
 
     def add_client(self, client_props):
-        self.queue.put(lambda: self._add_client(client_props))
-
-    def _add_client(self, client_props):
-        # Determine the button color based on the status
-        color = 'green'
-       
-        # Create a new button with the determined color
-        button = tk.Button(self.button_frame, text=client_props["n"], command=lambda: self.click_client(client_props), bg=color, font=("default", FONT_SIZE_TEXT))
-        # button.grid(row=0, column=0, padx=5, pady=5)
-
-        # Add the button to the dictionary
-        self.buttons[client_props["i"]] = button
-        self._update_button_positions()
+        self.view.update(client_props, 'active')
 
     def remove_client(self, client_id):
-        self.queue.put(lambda: self._remove_client(client_id))
-
-    def _remove_client(self, client_id):
-        # Remove the button from the dictionary and destroy it
-        if client_id in self.buttons:
-            button = self.buttons.pop(client_id, None)
-            if button is not None:
-                button.destroy()
-        self._update_button_positions()
-
-    def _update_button_positions(self):
-        if DEBUG_GUI:
-            print("GUI -- UPDATE POSITION")
-
-        # Remove all buttons from the button frame
-        for widget in self.button_frame.winfo_children():
-            widget.grid_forget()
-
-        # Add the buttons back to the button frame in the correct order
-        for i, button in enumerate(self.buttons.values()):
-            button.grid(row=i, column=0, padx=5, pady=5)  # Set the new position of the button
-            self.button_frame.grid_rowconfigure(i, weight=1)  # Adjust the row configuration
-
-        # Update the layout of the left frame
-        self.left_frame.update()
+        self.view.remove(client_id)
 
     def click_client(self, client_props):
         # Update the info label with the client's information
-        self.tech_info_label_name_response.config(text = f"{client_props['n']}")
-        self.tech_info_label_position_response.config(text = f"{client_props['i']}")
+        self.tech_info_label_name_response.config(text = client_props.name)
+        self.tech_info_label_position_response.config(text = client_props.client_id)
         
-        #Create a frame for the user 
-        self.tech_info_image = tk.Label(self.right_frame, image=self.imageToDisplay)
-        self.tech_info_image.image = self.imageToDisplay  # Keep a reference to the image
-
-        self.tech_info_image.grid(row=1, column=0, padx=10, pady=5)
+        #Show the user's photo, decoded on first view and cached after that
+        photo = self.photos.thumbnail(client_props)
+        if photo is not None:
+            self.tech_info_image.config(image=photo, text="", width=0, height=0)
+        else:
+            self.tech_info_image.config(image="", text="No photo", width=20, height=20)
+        self.tech_info_image.image = photo  # Keep a reference to the image
+
+    def show_report(self):
+        try:
+            with open(os.path.join(REPORT_DIR, "report.txt"), 'r') as file:
+                text = file.read()
+        except FileNotFoundError:
+            tkinter.messagebox.showinfo("Report", "No report yet, run report.py to make one")
+            return
+
+        window = tk.Toplevel(self.root)
+        window.title("Page Report")
+        textBox = tk.Text(window, width=80, height=30, font=("Courier", 12))
+        textBox.insert("1.0", text)
+        textBox.config(state="disabled")
+        textBox.grid(row=0, column=0, padx=5, pady=5)
+
+        # Requests by hour of the week, Monday at the top and midnight on the left
+        try:
+            heatmap = tk.PhotoImage(file=os.path.join(REPORT_DIR, "heatmap.ppm"))
+        except tk.TclError:
+            return
+        tk.Label(window, text="Requests by hour, Monday to Sunday", font=("default", FONT_SIZE_SUBTEXT)).grid(row=1, column=0)
+        heatmapLabel = tk.Label(window, image=heatmap)
+        heatmapLabel.image = heatmap  # Keep a reference to the image
+        heatmapLabel.grid(row=2, column=0, padx=5, pady=5)
 
     def togglePager(self, state):
         if state:
@@ -202,66 +281,77 @@ class ClientGUI:
 
     #Display a response to the user based on responseType
     #If there is an accepted page request display that as well.
+    #With several requests in flight the newest response replaces the one
+    #showing and gets the full RESPONSE_TIME_MS of its own.
     def response_disp(self, state, responseType, client_props=None):
-        if (responseType == "no_help"):
-            if ((state == True) & (self.displayingResponse == False)):
-                if DEBUG_GUI:
-                    print("GUI -- DISPLAYING disp")
-                self.displayingResponse = True
-                self.response_label.config(text=f"NO ONE AVAILABLE")
-                self.response_label.grid()
-                self.root.after(RESPONSE_TIME_MS, lambda: self.response_disp(False, "no_help"))
-            else:
-                self.displayingResponse = False
-                self.response_label.grid_remove()
-                if DEBUG_GUI:
-                    print("GUI -- REMOVING disp")
-        elif (responseType == "page_accept"):
-            if ((state == True) & (self.displayingResponse == False)):
-                if DEBUG_GUI:
-                    print("GUI -- accepted page request")
-                self.displayingResponse = True
-                self.response_label.config(text=f"{client_props['n']} is responding")
-                self.response_label.grid()
-                self.root.after(RESPONSE_TIME_MS, lambda: self.response_disp(False, "page_accept"))
-                self.increment_response_val('responses')
-            else:
-                self.displayingResponse = False
-                self.response_label.grid_remove()
-        else:
+        if (responseType not in ("no_help", "page_accept")):
             raise TypeError("ERROR: Invalid GUI response type")
+        if (state == False):
+            self._clear_response()
+            return
 
-    def send_pager_request(self):
-        #Make sure we are not already paging
-        if (self.isPaging == False):
+        if (responseType == "no_help"):
             if DEBUG_GUI:
-                print("Sending pager request...")
-            self.server_message_queue.put(lambda: pageRequestFlag())
+                print("GUI -- DISPLAYING disp")
+            text = "NO ONE AVAILABLE"
+        else:
+            if DEBUG_GUI:
+                print("GUI -- accepted page request")
+            text = f"{client_props.name} is responding"
 
-    def increment_response_val(self, key):
-        if DEBUG_GUI:
-            print("Increment response")
-        # Read the current values from the file
-        with open(self.analytics_file, 'r') as file:
-            data = json.load(file)
+        #The timer of the response being replaced would clear this one early
+        if self._responseTimer is not None:
+            self.root.after_cancel(self._responseTimer)
+        self.displayingResponse = True
+        self.response_label.config(text=text)
+        self.response_label.grid()
+        self._responseTimer = self.root.after(RESPONSE_TIME_MS, self._clear_response)
 
-        # Increment the value associated with the key
-        data[key] += 1
+        if (responseType == "page_accept"):
+            self.refresh_response_count()
 
-        # Write the new values back to the file
-        with open(self.analytics_file, 'w') as file:
-            json.dump(data, file)
+    def _clear_response(self):
+        if DEBUG_GUI:
+            print("GUI -- REMOVING disp")
+        if self._responseTimer is not None:
+            self.root.after_cancel(self._responseTimer)
+            self._responseTimer = None
+        self.displayingResponse = False
+        self.response_label.grid_remove()
 
+    def send_pager_request(self):
+        #Each press starts its own page request, even while another is calling
+        if DEBUG_GUI:
+            print("Sending pager request...")
+        self.server_message_queue.put(lambda: pageRequestFlag())
+        wakeService()
+
+    def refresh_response_count(self):
         # Update the response_label_number visual
-        self.response_label_number.config(text=f"Total Responses: {str(data['responses'])}")
+        responses = self.analytics.counters()["responses"]
+        self.response_label_number.config(text=f"Total Responses: {str(responses)}")
         
     #If you call this, don't expect to run through the rest of your program anytime soon. 
     def run(self):
-        self.check_queue()
+        self.root.after_idle(self._started)
         self.root.mainloop()
 
+    #Catch up on anything queued before the main loop ran, then start the
+    #fallback poll
+    def _started(self):
+        self.check_queue()
+        self._poll()
+
 def main():
-    gui = ClientGUI()
+    #Sites moved to worker processes run headless alongside the GUI
+    startWorkers()
+
+    #SIGUSR1 toggles profiling, SIGUSR2 dumps stacks, see profiling.py
+    install_signals()
+
+    analytics = openAnalytics("")
+
+    gui = ClientGUI(analytics)
 
     server_thread = threading.Thread(target=runStartup, args=(gui,))
     server_thread.start()
@@ -269,5 +359,12 @@ def main():
     # Run the GUI in the main thread
     gui.run()
 
+    #The service records events until its loop has stopped
+    stopService()
+    server_thread.join()
+
+    #Write out events still waiting for the next batch
+    analytics.stop()
+
 if __name__ == "__main__":
     main()
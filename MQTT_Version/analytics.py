@@ -0,0 +1,197 @@
+#Analytics log - Patron Handler Service
+#Page lifecycle events (request, each attempt, accept/deny/timeout with the
+#response latency, cancel when another badge accepted first, no help) are appended to a log as compact JSON lines by a
+#background thread, in batches, instead of rewriting a counters file on the
+#GUI thread for every accepted page.
+#
+#The counters the GUI shows are derived from the events. Compaction folds the
+#logged events into the counters snapshot (analytics.txt, same format as
+#before) and starts an empty log. Every event carries a sequence number and the
+#snapshot records the last one folded in, so a crash part way through
+#compaction can't count anything twice.
+#
+#Listeners (see timeseries.py) get every event as it is recorded. They keep
+#their own state on disk, written every ANALYTICS_CHECKPOINT_INTERVAL and when
+#the log is compacted, and are replayed the logged events they haven't seen on
+#start.
+
+import json
+import os
+import threading
+import time
+
+DEBUG_ANALYTICS = False
+
+ANALYTICS_LOG = "analytics.log"
+ANALYTICS_SNAPSHOT = "analytics.txt"
+ANALYTICS_FLUSH_INTERVAL = 2 #Seconds between batched writes
+ANALYTICS_COMPACT_EVENTS = 10000 #Logged events before they are folded into the snapshot
+ANALYTICS_CHECKPOINT_INTERVAL = 600 #Seconds between listener checkpoints while events come in
+
+#Event kinds
+EVENT_REQUEST = "request"
+EVENT_ATTEMPT = "attempt"
+EVENT_ACCEPT = "accept"
+EVENT_DENY = "deny"
+EVENT_TIMEOUT = "timeout"
+EVENT_CANCEL = "cancel" #Another badge of the ring group accepted first
+EVENT_NO_HELP = "no_help"
+
+#Counter each event kind adds to
+COUNTED_EVENTS = {
+    EVENT_ACCEPT: "responses",
+    EVENT_REQUEST: "visits",
+}
+
+def analytics_paths(name):
+    if not name:
+        return ANALYTICS_LOG, ANALYTICS_SNAPSHOT
+    return f"analytics-{name}.log", f"analytics-{name}.txt"
+
+class AnalyticsLog:
+    def __init__(self, log_path=ANALYTICS_LOG, snapshot_path=ANALYTICS_SNAPSHOT):
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._pending = [] #Encoded lines not yet written
+        self._thread = None
+        self._stopping = False
+        self.listeners = []
+        self.lastCheckpoint = time.monotonic()
+
+        self.sequence = 0 #Last event number handed out
+        self.compacted_through = 0 #Last event number folded into the snapshot
+        self.logged = 0 #Events in the log file
+        self.totals = {"responses": 0, "visits": 0, "partys": 0}
+
+    # listener.add(event) is called for each event after listener.through,
+    # listener.checkpoint() before logged events are dropped. Add before start.
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Load the snapshot and replay the log, then start the writer thread
+    def start(self):
+        self._load()
+        self._thread = threading.Thread(target=self._writer, name="analytics", daemon=True)
+        self._thread.start()
+
+    # Write out whatever is pending and stop the writer thread
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._wake.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    # Record an event. Cheap and safe from any thread, the write happens later.
+    def record(self, kind, **fields):
+        with self._lock:
+            self.sequence += 1
+            event = {"n": self.sequence, "t": round(time.time(), 3), "e": kind}
+            event.update(fields)
+            self._pending.append(json.dumps(event, separators=(',', ':')))
+            self._count(event)
+            for listener in self.listeners:
+                listener.add(event)
+
+    def counters(self):
+        with self._lock:
+            return dict(self.totals)
+
+    def _count(self, event):
+        counter = COUNTED_EVENTS.get(event["e"])
+        if counter is not None:
+            self.totals[counter] = self.totals.get(counter, 0) + 1
+
+    def _load(self):
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            snapshot = {}
+        self.compacted_through = snapshot.pop("compacted_through", 0)
+        self.totals.update(snapshot)
+        self.sequence = self.compacted_through
+
+        try:
+            with open(self.log_path, 'r') as file:
+                for line in file:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue #Torn write at the end of the log
+                    self.logged += 1
+                    self.sequence = max(self.sequence, event["n"])
+                    if event["n"] > self.compacted_through:
+                        self._count(event)
+                    for listener in self.listeners:
+                        if event["n"] > listener.through:
+                            listener.add(event)
+        except FileNotFoundError:
+            pass
+
+    def _writer(self):
+        while True:
+            with self._lock:
+                if not self._stopping:
+                    self._wake.wait(ANALYTICS_FLUSH_INTERVAL)
+                lines = self._pending
+                self._pending = []
+                stopping = self._stopping
+
+            if lines:
+                try:
+                    self._append(lines)
+                    if self.logged >= ANALYTICS_COMPACT_EVENTS:
+                        self._compact()
+                    elif (time.monotonic() - self.lastCheckpoint) >= ANALYTICS_CHECKPOINT_INTERVAL:
+                        self._checkpoint()
+                except OSError as e:
+                    print(f"Analytics write failed: {e}")
+                    with self._lock:
+                        self._pending = lines + self._pending
+            if stopping:
+                return
+
+    def _append(self, lines):
+        with open(self.log_path, 'a') as file:
+            file.write("\n".join(lines) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.logged += len(lines)
+        if DEBUG_ANALYTICS:
+            print(f"Analytics -- wrote {len(lines)} events")
+
+    def _checkpoint(self):
+        for listener in self.listeners:
+            listener.checkpoint()
+        self.lastCheckpoint = time.monotonic()
+
+    # Fold everything written so far into the snapshot and start a new log
+    def _compact(self):
+        with self._lock:
+            #Events still pending aren't in the log yet, leave them out
+            through = self.sequence - len(self._pending)
+            snapshot = dict(self.totals)
+            for line in self._pending:
+                counter = COUNTED_EVENTS.get(json.loads(line)["e"])
+                if counter is not None:
+                    snapshot[counter] -= 1
+        snapshot["compacted_through"] = through
+
+        tmpPath = self.snapshot_path + ".tmp"
+        with open(tmpPath, 'w') as file:
+            json.dump(snapshot, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmpPath, self.snapshot_path)
+        self._checkpoint()
+
+        #Only after the snapshot and listeners are safely on disk
+        open(self.log_path, 'w').close()
+        self.compacted_through = through
+        self.logged = 0
+        if DEBUG_ANALYTICS:
+            print(f"Analytics -- compacted through event {through}")
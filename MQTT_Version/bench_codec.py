@@ -0,0 +1,34 @@
+#Codec benchmark - Patron Handler Service
+#Compares the JSON and binary badge message formats: bytes on the wire and the
+#cost of encoding/decoding each message type.
+#
+#Usage: python bench_codec.py [iterations]
+
+import sys
+import timeit
+
+import codec
+
+MESSAGES = [
+    ("register", codec.MSG_REGISTER, {"i": "A0:A3:B3:2D:C6:2C", "p": 0, "n": "Logan", "s": 1, "r": 0}),
+    ("health", codec.MSG_HEALTH, {"i": "A0:A3:B3:2D:C6:2C", "p": 1}),
+    ("pager", codec.MSG_PAGER, {"i": "A0:A3:B3:2D:C6:2C", "r": 1}),
+]
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    print(f"{'message':<10}{'format':<8}{'bytes':>7}{'encode us':>12}{'decode us':>12}")
+    for name, kind, msg in MESSAGES:
+        jsonPayload = codec.encode_json(msg)
+        binaryPayload = codec.encode_binary(kind, msg)
+        assert codec.decode(binaryPayload) == codec.decode(jsonPayload)
+
+        for fmt, payload, encode in (("json", jsonPayload, lambda: codec.encode_json(msg)),
+                                     ("binary", binaryPayload, lambda: codec.encode_binary(kind, msg))):
+            encodeTime = timeit.timeit(encode, number=iterations) / iterations
+            decodeTime = timeit.timeit(lambda: codec.decode(payload), number=iterations) / iterations
+            print(f"{name:<10}{fmt:<8}{len(payload):>7}{encodeTime * 1e6:>12.2f}{decodeTime * 1e6:>12.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#Wire codec - Patron Handler Service
+#Badges can send their messages as JSON or in a compact binary form. The
+#format is detected per message from the first byte: JSON always starts with
+#'{', binary messages start with BINARY_MAGIC | version.
+#
+#Binary layout (big endian), version 1:
+#  header    B magic|version, B message type, 6s badge MAC
+#  register  B status, B response, B name length, name (utf-8)
+#  health    B ping
+#  pager     B response
+#
+#Either way a message decodes to the same dict the JSON form has
+#({"i": ..., "n": ..., "p": ..., "s": ..., "r": ...}), so callers don't care.
+#
+#Page requests come from kiosks rather than badges and are JSON only,
+#{"k": <kiosk id>}.
+
+import json
+import struct
+
+BINARY_MAGIC = 0xB0 #High nibble, the low nibble is the format version
+BINARY_VERSION = 1
+
+MSG_REGISTER = 0
+MSG_HEALTH = 1
+MSG_PAGER = 2
+MSG_REQUEST = 3 #Kiosk page request, JSON only
+
+_HEADER = struct.Struct(">BB6s")
+_REGISTER = struct.Struct(">BBB")
+_BYTE = struct.Struct(">B")
+_SHORT = struct.Struct(">BB6sB") #Header plus one byte, health and pager
+_SHORT_SIZE = _SHORT.size
+_MAGIC_V1 = BINARY_MAGIC | BINARY_VERSION
+
+class CodecError(ValueError):
+    pass
+
+def is_binary(payload):
+    return len(payload) > 0 and (payload[0] & 0xF0) == BINARY_MAGIC
+
+def _mac_bytes(client_id):
+    try:
+        packed = bytes.fromhex(client_id.replace(':', ''))
+    except ValueError:
+        packed = b''
+    if len(packed) != 6:
+        raise CodecError(f"{client_id!r} is not a MAC address")
+    return packed
+
+_macStrings = {} #Packed MAC -> client id string, one entry per badge seen
+
+def _mac_string(packed):
+    macString = _macStrings.get(packed)
+    if macString is None:
+        macString = _macStrings[packed] = packed.hex(':').upper()
+    return macString
+
+# Decode a badge message of either format. Anything that isn't a message
+# raises a ValueError (CodecError or a JSON/UTF-8 error).
+def decode(payload):
+    if not is_binary(payload):
+        message = json.loads(payload.decode('utf-8'))
+        if not isinstance(message, dict):
+            raise CodecError(f"Expected a JSON object, got {type(message).__name__}")
+        return message
+
+    #Health and pager messages are fixed size, the common case
+    if len(payload) == _SHORT_SIZE:
+        magic, kind, mac, value = _SHORT.unpack(payload)
+        if magic == _MAGIC_V1:
+            if kind == MSG_HEALTH:
+                return {"i": _mac_string(mac), "p": value}
+            if kind == MSG_PAGER:
+                return {"i": _mac_string(mac), "r": value}
+
+    if len(payload) < _HEADER.size:
+        raise CodecError("Binary message shorter than its header")
+    magic, kind, mac = _HEADER.unpack_from(payload)
+    if magic != _MAGIC_V1:
+        raise CodecError(f"Unsupported binary message version {magic & 0x0F}")
+    if kind != MSG_REGISTER:
+        raise CodecError(f"Unknown or malformed binary message type {kind}")
+
+    start = _HEADER.size + _REGISTER.size
+    if len(payload) < start:
+        raise CodecError("Binary register message cut short")
+    status, response, nameLen = _REGISTER.unpack_from(payload, _HEADER.size)
+    if len(payload) < start + nameLen:
+        raise CodecError("Binary register message cut short")
+    return {"i": _mac_string(mac), "n": payload[start:start + nameLen].decode('utf-8'),
+            "p": 0, "s": status, "r": response}
+
+# Encode a badge message in binary, the way the badge firmware does. Used by
+# tools and benchmarks, the service itself only decodes.
+def encode_binary(kind, msg):
+    header = _HEADER.pack(BINARY_MAGIC | BINARY_VERSION, kind, _mac_bytes(msg["i"]))
+    if kind == MSG_REGISTER:
+        name = msg["n"].encode('utf-8')[:255]
+        return header + _REGISTER.pack(msg["s"], msg["r"], len(name)) + name
+    elif kind == MSG_HEALTH:
+        return header + _BYTE.pack(msg["p"])
+    elif kind == MSG_PAGER:
+        return header + _BYTE.pack(msg["r"])
+    raise CodecError(f"Unknown binary message type {kind}")
+
+def encode_json(msg):
+    return json.dumps(msg, separators=(',', ':')).encode('utf-8')
@@ -0,0 +1,89 @@
+#GUI task queue - Patron Handler Service
+#Tasks the service hands to the Tk thread, run in priority order and only for
+#as long as the frame budget allows. What doesn't fit carries over to the next
+#frame, so a burst can't freeze the main loop and a page being accepted is
+#never stuck behind routine refreshes.
+
+import heapq
+import itertools
+import threading
+import time
+
+from metrics import GUI_DRAIN_SECONDS
+
+#Task priorities, lower runs first
+PRIORITY_RESPONSE = 0 #Page accepted / no help displays
+PRIORITY_INDICATOR = 1 #Paging indicator
+PRIORITY_NORMAL = 2 #Everything else. Badge colours are redrawn after all tasks, see viewmodel.py
+
+class TaskQueue:
+    #notify is called, from the putting thread, when a task lands in an empty
+    #queue so the Tk thread can be woken up
+    def __init__(self, notify=None):
+        self.notify = notify
+        self._lock = threading.Lock()
+        self._heap = []
+        self._counter = itertools.count() #Keeps equal priorities in FIFO order
+
+        #Counters
+        self.queued = 0
+        self.ran = 0
+        self.max_depth = 0
+        self.carried_over = 0 #Frames that ran out of budget with tasks left
+        self.last_drain_ms = 0
+        self.max_drain_ms = 0
+        self.total_drain_ms = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    # Safe to call from any thread
+    def put(self, task, priority=PRIORITY_NORMAL):
+        with self._lock:
+            wasEmpty = not self._heap
+            heapq.heappush(self._heap, (priority, next(self._counter), task))
+            self.queued += 1
+            self.max_depth = max(self.max_depth, len(self._heap))
+        if wasEmpty and self.notify is not None:
+            self.notify()
+
+    def empty(self):
+        return not self._heap
+
+    # Run tasks, highest priority first, until the queue is empty or budget_ms
+    # has been spent. Tk thread only. Returns the number of tasks run.
+    def run(self, budget_ms):
+        start = time.perf_counter()
+        deadline = start + budget_ms / 1000
+        count = 0
+        while True:
+            with self._lock:
+                if not self._heap:
+                    break
+                task = heapq.heappop(self._heap)[2]
+            task()
+            count += 1
+            if time.perf_counter() >= deadline:
+                break
+
+        elapsed = (time.perf_counter() - start) * 1000
+        GUI_DRAIN_SECONDS.observe(elapsed / 1000)
+        self.ran += count
+        self.last_drain_ms = elapsed
+        self.max_drain_ms = max(self.max_drain_ms, elapsed)
+        self.total_drain_ms += elapsed
+        if self._heap:
+            self.carried_over += 1
+        return count
+
+    def stats(self):
+        return {
+            "depth": len(self._heap),
+            "max_depth": self.max_depth,
+            "queued": self.queued,
+            "ran": self.ran,
+            "carried_over": self.carried_over,
+            "last_drain_ms": self.last_drain_ms,
+            "max_drain_ms": self.max_drain_ms,
+            "total_drain_ms": self.total_drain_ms,
+        }
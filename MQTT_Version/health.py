@@ -0,0 +1,63 @@
+#Health probes - Patron Handler Service
+#Keeps track of the COMMAND_HEALTH request outstanding for each client. Once a
+#client's last ping is stale it gets one probe, and unanswered probes are
+#retried on a backoff schedule until the client's probe budget is spent.
+#Clients that stay silent are left to go INACTIVE/OFFLINE on their own timers.
+
+DEBUG_HEALTH = False
+
+#Seconds from each unanswered probe to the retry after it, one entry per retry.
+#Probes go out when the ping goes stale, then 1s and 3s after that, all before
+#the client goes INACTIVE (CLIENT_STATUS_INACTIVE_TIME in main.py) and the
+#sweep stops probing it.
+HEALTH_PROBE_BACKOFF = [1, 2]
+HEALTH_PROBE_BUDGET = len(HEALTH_PROBE_BACKOFF) + 1 #Probes sent to a silent client, the first plus one per retry
+HEALTH_SWEEP_PROBE_BUDGET = 64 #Probes sent in one sweep, the rest wait for the next one
+
+class Probe:
+    __slots__ = ("first_sent", "last_sent", "attempts")
+
+    def __init__(self, now):
+        self.first_sent = now
+        self.last_sent = now
+        self.attempts = 0
+
+class HealthProber:
+    def __init__(self, send_probe):
+        self.send_probe = send_probe
+        self.outstanding = {} #client_id -> Probe
+
+    # When the next probe to client_id should go out, or None if its budget is
+    # spent. stale_at is the time the client's last ping went stale.
+    def next_probe_time(self, client_id, stale_at):
+        probe = self.outstanding.get(client_id)
+        if probe is None:
+            return stale_at
+        if probe.attempts >= HEALTH_PROBE_BUDGET:
+            return None
+        return probe.last_sent + HEALTH_PROBE_BACKOFF[probe.attempts - 1]
+
+    def send(self, client_id, now):
+        probe = self.outstanding.get(client_id)
+        if probe is None:
+            probe = self.outstanding[client_id] = Probe(now)
+        probe.attempts += 1
+        probe.last_sent = now
+
+        if DEBUG_HEALTH:
+            print(f"Health -- probe {probe.attempts} to {client_id}")
+        self.send_probe(client_id)
+
+    # The client answered (or re-registered). Returns the time since the first
+    # probe, or None if nothing was outstanding.
+    def answered(self, client_id, now):
+        probe = self.outstanding.pop(client_id, None)
+        if probe is None:
+            return None
+        return now - probe.first_sent
+
+    def forget(self, client_id):
+        self.outstanding.pop(client_id, None)
+
+    def in_flight(self):
+        return len(self.outstanding)
@@ -0,0 +1,48 @@
+#Ingress queue - Patron Handler Service
+#The MQTT message callbacks only append the raw message here; decoding, registry
+#updates and GUI work happen when the service loop drains the queue, so reading
+#the socket is never held up by application work.
+#
+#A badge answers every health probe with the same bytes, so health messages
+#repeated within one batch are coalesced before they are even decoded.
+
+import collections
+import time
+
+from codec import MSG_HEALTH
+
+DEBUG_INGRESS = False
+
+INGRESS_BATCH_SIZE = 256 #Messages handled per pass of the service loop
+
+class Ingress:
+    def __init__(self):
+        self.pending = collections.deque() #(kind, topic, payload, time received) in arrival order
+        self.received = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, kind, topic, payload):
+        self.pending.append((kind, topic, payload, time.time()))
+        self.received += 1
+
+    # Up to INGRESS_BATCH_SIZE messages, oldest first, with repeated health
+    # messages dropped
+    def take_batch(self):
+        batch = []
+        healthSeen = set()
+        for _ in range(min(len(self.pending), INGRESS_BATCH_SIZE)):
+            message = self.pending.popleft()
+            kind, topic, payload, received = message
+            if kind == MSG_HEALTH:
+                if (topic, payload) in healthSeen:
+                    self.coalesced += 1
+                    continue
+                healthSeen.add((topic, payload))
+            batch.append(message)
+
+        if DEBUG_INGRESS and batch:
+            print(f"Ingress -- {len(batch)} messages, {len(self.pending)} waiting, {self.coalesced} coalesced so far")
+        return batch
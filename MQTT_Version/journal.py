@@ -0,0 +1,94 @@
+#Registry journal - Patron Handler Service
+#Keeps the badges a site knows about on disk so a restart doesn't need every
+#badge to register again. Changes are appended as JSON lines ("add" with the
+#badge's name, "del" when it is removed) and flushed periodically, except that
+#main.py writes new badges straight away (see applyRegistrations). Once the
+#log is mostly superseded entries it is compacted into a fresh file holding one
+#"add" per known badge, written beside it and swapped in with os.replace.
+
+import json
+import os
+
+DEBUG_JOURNAL = False
+
+JOURNAL_FLUSH_INTERVAL = 5 #Seconds between writes of pending renames and removals
+JOURNAL_COMPACT_MIN = 64 #Lines the log may hold before compaction is considered
+
+def journal_path(site_name):
+    return f"registry-{site_name}.log" if site_name else "registry.log"
+
+class RegistryJournal:
+    def __init__(self, path):
+        self.path = path
+        self.known = {} #client_id -> name, as of the last write
+        self.pending = [] #Lines not yet on disk
+        self.lines = 0 #Lines in the log file
+
+    # Replay the log. Returns [(client_id, name)] for every badge still known.
+    # A line cut short by a crash mid-write, or that isn't a journal entry, is
+    # skipped.
+    def load(self):
+        self.known = {}
+        self.lines = 0
+        try:
+            with open(self.path, 'r') as file:
+                for line in file:
+                    self.lines += 1
+                    try:
+                        entry = json.loads(line)
+                        if not isinstance(entry, dict):
+                            raise ValueError("not an entry")
+                        if entry.get("op") == "add":
+                            self.known[entry["i"]] = entry["n"]
+                        elif entry.get("op") == "del":
+                            self.known.pop(entry["i"], None)
+                    except (ValueError, KeyError, TypeError):
+                        if DEBUG_JOURNAL:
+                            print(f"Journal -- skipping damaged line in {self.path}")
+                        continue
+        except FileNotFoundError:
+            pass
+        return list(self.known.items())
+
+    # The badge registered, only new badges and renames are written
+    def record(self, record):
+        if self.known.get(record.client_id) == record.name:
+            return
+        self.known[record.client_id] = record.name
+        self.pending.append({"op": "add", "i": record.client_id, "n": record.name})
+
+    def forget(self, client_id):
+        if self.known.pop(client_id, None) is None:
+            return
+        self.pending.append({"op": "del", "i": client_id})
+
+    # Write pending changes, compacting the log when most of it is stale
+    def flush(self):
+        if not self.pending:
+            return
+        if (self.lines + len(self.pending)) > max(JOURNAL_COMPACT_MIN, 2 * len(self.known)):
+            self.compact()
+            return
+
+        with open(self.path, 'a') as file:
+            for entry in self.pending:
+                file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.lines += len(self.pending)
+        self.pending = []
+
+    # Rewrite the log with one entry per known badge
+    def compact(self):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, 'w') as file:
+            for client_id, name in self.known.items():
+                file.write(json.dumps({"op": "add", "i": client_id, "n": name}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmpPath, self.path)
+
+        if DEBUG_JOURNAL:
+            print(f"Journal -- compacted {self.path} from {self.lines} to {len(self.known)} lines")
+        self.lines = len(self.known)
+        self.pending = []
@@ -0,0 +1,50 @@
+#Liveness index - Patron Handler Service
+#Min-heap of the next time each client needs attention from the health sweep
+#(ping due, probe retry, going INACTIVE or OFFLINE). The sweep only pops the
+#clients whose deadline has passed instead of walking the whole registry.
+#
+#Rescheduling a client just pushes a new entry; the old one is recognised as
+#stale when it reaches the top because it no longer matches record.liveness_due.
+
+import heapq
+import itertools
+
+class LivenessIndex:
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    # Set the next time the sweep should look at record
+    def schedule(self, record, due):
+        record.liveness_due = due
+        heapq.heappush(self._heap, (due, next(self._counter), record))
+
+    # Stop tracking record, e.g. when it is removed from the registry
+    def discard(self, record):
+        record.liveness_due = None
+
+    # Earliest pending deadline, or None if no client is tracked
+    def next_due(self):
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    # Remove and return every record whose deadline is at or before now
+    def pop_expired(self, now):
+        expired = []
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return expired
+            record = heapq.heappop(self._heap)[2]
+            record.liveness_due = None
+            expired.append(record)
+
+    def _discard_stale(self):
+        while self._heap:
+            due, count, record = self._heap[0]
+            if record.liveness_due == due:
+                return
+            heapq.heappop(self._heap)
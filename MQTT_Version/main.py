@@ -1,89 +1,91 @@
 #Patron Handler Service - MQTT - 4/30/24
 #Setup like an embedded system
+#Runs on a single asyncio event loop: MQTT socket I/O, message callbacks,
+#timers and the paging state machines all share the service thread.
+#A service process handles one or more sites, see sites.py.
 
+import asyncio
+import sys
 import time
 import paho.mqtt.client as mqtt
-import json
-from enum import Enum
-import threading
-import queue
+import multiprocessing
+
+from scheduler import Scheduler
+from mqtt_async import AsyncioHelper
+from publisher import Publisher
+from health import HealthProber, HEALTH_SWEEP_PROBE_BUDGET
+from paging import PagingEngine
+import codec
+from codec import MSG_REGISTER, MSG_HEALTH, MSG_PAGER, MSG_REQUEST
+from ingress import Ingress
+from sites import Site, HeadlessGUI, LOCAL_SITES, WORKER_SITES, site_name, group_name
+from journal import JOURNAL_FLUSH_INTERVAL
+from analytics import AnalyticsLog, analytics_paths
+from timeseries import PageStore, page_store_path
+import metrics
+from metrics import Sampled, LOOP_ITERATION_SECONDS, LOOP_STAGE_SECONDS, METRICS_PORT
+from profiling import WATCHDOG, install_signals
+import tracing
+from registration import REGISTER_WAVE_COHORTS, REGISTER_WAVE_INTERVAL, REGISTER_BATCH_INTERVAL
+from registration import LEGACY_REGISTER_FALLBACK, LEGACY_REGISTER_DELAY
+from registry import CLIENT_STATUS_OFFLINE, CLIENT_STATUS_INACTIVE, CLIENT_STATUS_ACTIVE
 
 #Debug constants
-DEBUG_STATEMACHINE = False
 DEBUG_COMM = False
 
 #MQTT Server Properties
 SERVER_IP_ADDRESS = '10.2.117.37'
 SERVER_IP_ADDRESS_PORT = 1883
+MQTT_CLIENT_ID = "rpi_client1" #Worker processes append their site names
 
 #Event timing values
 TIME_BETWEEN_PINGS = 4
+HEALTH_SWEEP_MIN_INTERVAL = .2 #Clients coming due this close together share one sweep
+RECONNECT_DELAY = 5 #Seconds between attempts to reach a lost MQTT server
 CLIENT_STATUS_INACTIVE_TIME = 10
 CLIENT_STATUS_OFFLINE_TIME = 20
-
-#Client status ENUMS
-CLIENT_STATUS_OFFLINE = 0
-CLIENT_STATUS_INACTIVE = 1
-CLIENT_STATUS_ACTIVE = 2
+WARM_START_SPREAD = 2 #Seconds the health checks of badges restored from disk are spread over
+ROLL_CALL_DELAY = WARM_START_SPREAD + 1 #Seconds after a warm start before asking unknown badges to register
 
 #Command ENUMS
 COMMAND_REGISTER = 0
 COMMAND_HEALTH = 1
 COMMAND_PAGE = 2
 COMMAND_CANCEL = 3
-
-#Client response ENUMS
-RESPONSE_NONE   = 0
-RESPONSE_ACCEPT = 1
-RESPONSE_DENY   = 2
-
-#State machine variables
-class ServerState(Enum):
-    IDLE_STATE = 0
-    CALLING_STATE = 1
-    NO_HELP_STATE = 2
-    ACKED_STATE = 3
-    REFUSED_STATE = 4
-
-#ServerState machine timing values
-MILLIS_TO_SEC = 1000
-WAIT_TIME_MS = 8000
-ERROR_BLINK_MS = 1000
-STATUS_DISPLAY_MS = 2000
-
-currentState = None
-button_call_pressed = False
-callAckFlag = 0
-callRefusedFlag = 0
-attempted_receivers = 0
+COMMAND_ROLL_CALL = 4 #Register unless the server has been in touch recently
+COMMAND_REGISTER_WAVE = 5 #"5 <cohort> <cohorts>", register if in that cohort, see registration.py
 
 #Test variable we change based on the number of health requests
 #Only using this until the button call functionality is implemented
 BUTTON_CALL_COUNT = 1
 button_call_var = 0
 
-# Timing variables
-currentTime = time.time()
-previousTime = 0
-deltaTime = 0
-
-# Define as a dictionary
-registered_clients = {}
+# Sites served by this process by name, each with its own registry and paging
+sites = {}
+ingress = Ingress() #Badge messages waiting for the service loop
 client_sub = None
-delayCounter = 0
+mqtt_helper = None
+publisher = None
 
 flag_connected = 0
+reconnecting = False #A reconnect is running on an executor thread
+stopping = False #stopService was called, the service loop ends after its pass
 
 server_gui = None
+analytics = None #Page lifecycle event log, shared by every site
+pages = None #Time series of those events for queries, see timeseries.py
 
-# Initialize current client_id
-current_client_id = None
-prev_client_id = None
+# Deadline driven timers for everything the service loop waits on
+scheduler = Scheduler()
+
+#Kiosk id used for page requests made from this service's own GUI
+LOCAL_KIOSK = 'local'
 
 # Fires whever we publish on a topic
 def on_publish(client, userdata, mid):
     if DEBUG_COMM:
         print("message published")
+    publisher.published(mid)
 
 # Fires whever we connect to the MQTT server/broker
 def on_connect(client, userdata, flags, rc):
@@ -103,331 +105,556 @@ def on_disconnect(client, userdata, rc):
     if DEBUG_COMM:
         print("Disconnected from MQTT server")
 
-#Register the client ID in a dictionary with its information packet
+    #Anything not yet written is lost with the connection
+    publisher.reset("Disconnected before message was published")
+
+    #paho's network thread used to reconnect for us, now the service loop does
+    if rc != mqtt.MQTT_ERR_SUCCESS:
+        scheduler.call_later(RECONNECT_DELAY, reconnectBroker)
+
+#reconnectBroker
+#Try to reach the MQTT server again, rescheduling itself until it succeeds.
+#The connect blocks until the server answers or times out, so it runs on an
+#executor thread and the service loop carries on meanwhile.
+def reconnectBroker():
+    global reconnecting
+    if flag_connected == 1 or reconnecting:
+        return
+
+    print("trying to connect MQTT server..")
+    reconnecting = True
+    mqtt_helper.loop.run_in_executor(None, client_sub.reconnect).add_done_callback(reconnectDone)
+
+def reconnectDone(future):
+    global reconnecting
+    reconnecting = False
+    e = future.exception()
+    if e is not None:
+        print(e)
+        scheduler.call_later(RECONNECT_DELAY, reconnectBroker)
+
+# Message callbacks
+# They run while paho reads the socket, so all they do is queue the message.
+# drainIngress does the work from the service loop.
 def RegisterCallback(client, userdata, msg):
-    if DEBUG_COMM:
-        print('RPi Broadcast message:  ', str(msg.payload.decode('utf-8')))
-    
-    global server_gui
-    client_props = json.loads(msg.payload.decode('utf-8'))
-    print(client_props["i"])
+    ingress.put(MSG_REGISTER, msg.topic, msg.payload)
+    scheduler.wake()
+
+def HealthCallback(client, userdata, msg):
+    ingress.put(MSG_HEALTH, msg.topic, msg.payload)
+    scheduler.wake()
+
+def PagerCallback(client, userdata, msg):
+    ingress.put(MSG_PAGER, msg.topic, msg.payload)
+    scheduler.wake()
+
+def RequestCallback(client, userdata, msg):
+    ingress.put(MSG_REQUEST, msg.topic, msg.payload)
+    scheduler.wake()
+
+#drainIngress
+#Handle a batch of queued badge messages. If more are waiting the loop comes
+#straight back after reading the socket again.
+def drainIngress():
+    currentTime = time.time()
+    for kind, topic, payload, received in ingress.take_batch():
+        site = siteFor(topic)
+        if kind == MSG_REGISTER:
+            queueRegistration(site, payload)
+            continue
+
+        try:
+            client_props = codec.decode(payload)
+            if kind == MSG_HEALTH:
+                handleHealth(site, client_props, currentTime)
+            elif kind == MSG_REQUEST:
+                handleRequest(site, client_props, currentTime)
+            else:
+                handlePager(site, client_props, currentTime, received)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Bad message on {topic}: {e}")
 
-    registered_clients[client_props["i"]] = client_props
-    registered_clients[client_props["i"]]["p"] = time.time()
+
+    if ingress:
+        scheduler.wake()
+
+#queueRegistration
+#Queue a client's information packet, registrations are applied in batches
+def queueRegistration(site, payload):
+    if DEBUG_COMM:
+        print('RPi Broadcast message:  ', str(payload))
     
-    #Update any visuals to show a new client has connected
-    server_gui.queue.put(lambda: server_gui.update_status(registered_clients[client_props["i"]],'active'))
+    site.registration.queue(payload)
+    if site.registration.batchTimer is None:
+        site.registration.batchTimer = scheduler.call_later(REGISTER_BATCH_INTERVAL, lambda: applyRegistrations(site))
+
+#applyRegistrations
+#Register the client IDs of a batch of queued information packets, as many as
+#the site's token bucket allows. The rest wait for the next batch.
+def applyRegistrations(site):
+    intake = site.registration
+    intake.batchTimer = None
+    currentTime = time.time()
 
-# HealthCallback
+    added = False
+    for payload in intake.take_batch(currentTime):
+        try:
+            client_props = codec.decode(payload)
+            print(client_props["i"])
+            record, is_new = site.registry.register(client_props["i"], client_props["n"], currentTime)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Bad register message: {e}")
+            continue
+        site.health_prober.answered(record.client_id, currentTime)
+        site.journal.record(record)
+        added = added or is_new
+
+        #Make sure the new client gets its health checks
+        trackLiveness(site, record, record.last_ping + TIME_BETWEEN_PINGS)
+
+        #Update any visuals to show a new client has connected
+        server_gui.view.update(record,'active')
+
+    #New badges go to disk before the server contacts them. A badge that has
+    #heard from the server skips the roll call after a restart, so it must
+    #already be in the journal by then.
+    if added:
+        flushJournalNow(site)
+    else:
+        saveRegistry(site)
+
+    if intake.pending:
+        intake.batchTimer = scheduler.call_later(REGISTER_BATCH_INTERVAL, lambda: applyRegistrations(site))
+
+#startRegistrationWaves
+#Ask every badge of the site to register, one cohort at a time
+def startRegistrationWaves(site):
+    intake = site.registration
+    if intake.waveTimer is not None:
+        intake.waveTimer.cancel()
+    intake.nextCohort = 0
+    sendRegistrationWave(site)
+
+def sendRegistrationWave(site):
+    intake = site.registration
+    intake.waveTimer = None
+    global_publish(COMMAND_REGISTER_WAVE, site, intake.nextCohort, REGISTER_WAVE_COHORTS)
+    intake.nextCohort += 1
+    if intake.nextCohort < REGISTER_WAVE_COHORTS:
+        intake.waveTimer = scheduler.call_later(REGISTER_WAVE_INTERVAL, lambda: sendRegistrationWave(site))
+    else:
+        scheduleLegacyRegister(site)
+
+#sendRollCall
+#After a warm start, ask the badges the journal didn't know to register
+def sendRollCall(site):
+    global_publish(COMMAND_ROLL_CALL, site)
+    scheduleLegacyRegister(site)
+
+#scheduleLegacyRegister
+#Badges on older firmware ignore registration waves and the roll call, follow
+#them with one plain register request. See registration.py.
+def scheduleLegacyRegister(site):
+    if LEGACY_REGISTER_FALLBACK:
+        scheduler.call_later(LEGACY_REGISTER_DELAY, lambda: global_publish(COMMAND_REGISTER, site))
+
+# handleHealth
 # Records which client is reporting back on a health update request
-def HealthCallback(client, userdata, msg):
+def handleHealth(site, client_props, currentTime):
     if DEBUG_COMM:
         print('Health Callback')
-    client_props = json.loads(msg.payload.decode('utf-8'))
-    registered_clients[client_props["i"]]["p"] = time.time()
-    registered_clients[client_props["i"]]["s"] = CLIENT_STATUS_ACTIVE
+    record = site.registry.get(client_props["i"])
+    if record is None:
+        if DEBUG_COMM:
+            print(f"Health reply from unregistered client {client_props['i']}")
+        #Whoever it is, it's alive. Have it introduce itself.
+        client_publish(client_props["i"], COMMAND_REGISTER, site)
+        return
+
+    site.registry.touch(record, currentTime)
+    site.health_prober.answered(record.client_id, currentTime)
+    trackLiveness(site, record, record.last_ping + TIME_BETWEEN_PINGS)
 
-    server_gui.queue.put(lambda: server_gui.update_status(registered_clients[client_props["i"]],'active'))
+    #Repeats of the same state never reach Tk, see viewmodel.py
+    server_gui.view.update(record,'active')
 
-# PagerCallback
+# handlePager
 # Handles page responses from clients depending on their response
-def PagerCallback(client, userdata, msg):
+def handlePager(site, client_props, currentTime, received=None):
     if DEBUG_COMM:
         print('Pager Callback')
 
-    global callAckFlag
-    global callRefusedFlag
-    
-    client_props = json.loads(msg.payload.decode('utf-8'))
-    registered_clients[client_props["i"]]["r"] = client_props["r"]
-
-    if (client_props["r"] == RESPONSE_ACCEPT):
+    record = site.registry.get(client_props["i"])
+    if record is None:
         if DEBUG_COMM:
-            print("client accepted")
-        callAckFlag = True
-        server_gui.queue.put(lambda: server_gui.update_status(registered_clients[client_props["i"]],'active'))
-        server_gui.queue.put(lambda: server_gui.response_disp(True,"page_accept", registered_clients[client_props["i"]]))
-    elif (client_props["r"] == RESPONSE_DENY):
+            print(f"Page response from unregistered client {client_props['i']}")
+        return
+    record.response = client_props["r"]
+
+    #Late answers from badges that are no longer ringing don't count
+    if (not site.paging.on_response(record, client_props["r"], currentTime, received)):
         if DEBUG_COMM:
-            print("client denied")
-        callRefusedFlag = True
+            print(f"Ignoring page response from {record.client_id}")
+
+# handleRequest
+# Starts a page request for a kiosk of the site. Kiosks publish {"k": <kiosk id>}
+# on the site's server/request topic, which is how sites other than the GUI's
+# own, and sites in worker processes, get paged for.
+def handleRequest(site, client_props, currentTime):
+    if DEBUG_COMM:
+        print(f"Page request from kiosk {client_props['k']} at {site!r}")
+    site.paging.request(str(client_props["k"]), currentTime)
+
+#siteFor
+#The site a message arrived for. Callbacks are only linked for our own sites.
+def siteFor(topic):
+    return sites[site_name(topic)]
 
 # Make the necessary subscriptions to response to what the clients are broadcasting
 def client_subscriptions(client):
-    client.subscribe("server/register")
-    client.subscribe("server/health")
-    client.subscribe("server/pager")
+    for site in sites.values():
+        client.subscribe(site.topic("server/register"))
+        client.subscribe(site.topic("server/health"))
+        client.subscribe(site.topic("server/pager"))
+        client.subscribe(site.topic("server/request"))
 
 # Initial setup of the client and connection to the MQTT server
-def setup():
+def setup(site_names, client_name):
     print("Setting up Patron Handler Service - RaspberryPi")
 
     global client_sub
-    client_sub = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,"rpi_client1") #this should be a unique name
+    global mqtt_helper
+    global publisher
+    client_sub = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,client_name) #this should be a unique name
+
+    #Drive the MQTT socket from the service's event loop instead of paho's thread
+    mqtt_helper = AsyncioHelper(asyncio.get_running_loop(), client_sub)
+    publisher = Publisher(asyncio.get_running_loop(), client_sub)
+
+    for name in site_names:
+        site = sites[name] = Site(name)
+        site.health_prober = HealthProber(lambda client_id, site=site: client_publish(client_id, COMMAND_HEALTH, site))
+        site.paging = PagingEngine(site.registry, site.ranker, scheduler,
+                                   lambda client_id, site=site: client_publish(client_id, COMMAND_PAGE, site),
+                                   lambda client_id, site=site: client_publish(client_id, COMMAND_CANCEL, site),
+                                   server_gui, analytics, name)
 
     #link callback events
     client_sub.on_connect = on_connect
     client_sub.on_disconnect = on_disconnect
     
     #Link callbacks
-    client_sub.message_callback_add('server/register', RegisterCallback)
-    client_sub.message_callback_add('server/health', HealthCallback)
-    client_sub.message_callback_add('server/pager', PagerCallback)
+    for site in sites.values():
+        client_sub.message_callback_add(site.topic('server/register'), RegisterCallback)
+        client_sub.message_callback_add(site.topic('server/health'), HealthCallback)
+        client_sub.message_callback_add(site.topic('server/pager'), PagerCallback)
+        client_sub.message_callback_add(site.topic('server/request'), RequestCallback)
 
     client_sub.on_publish = on_publish
 
     client_sub.connect(SERVER_IP_ADDRESS, SERVER_IP_ADDRESS_PORT)
-    # start a new thread
-    client_sub.loop_start()
     client_subscriptions(client_sub)
 
-    # setup state machine
-    global currentState
-    currentState = ServerState.IDLE_STATE
-
-    #TODO ask all of the clients to register with the server
-    global_publish(COMMAND_REGISTER)
+    registerMetrics()
+
+    #Pick up the badges we knew about before a restart, and only ask the
+    #ones we don't know to register
+    for site in sites.values():
+        if restoreRegistry(site, time.time()):
+            scheduler.call_later(ROLL_CALL_DELAY, lambda site=site: sendRollCall(site))
+        else:
+            startRegistrationWaves(site)
+
+#registerMetrics
+#Queue depths and badge counts, read whenever the metrics are scraped
+def registerMetrics():
+    statuses = (("active", CLIENT_STATUS_ACTIVE), ("inactive", CLIENT_STATUS_INACTIVE), ("offline", CLIENT_STATUS_OFFLINE))
+
+    #TaskQueue counters, nothing for the headless GUI of a worker
+    def guiStat(key):
+        stats = server_gui.queue.stats()
+        return [((), stats[key])] if key in stats else []
+
+    for metric in (
+        Sampled("patron_ingress_depth", "Badge messages waiting for the service loop", lambda: [((), len(ingress))]),
+        Sampled("patron_ingress_received_total", "Badge messages received", lambda: [((), ingress.received)], kind="counter"),
+        Sampled("patron_ingress_coalesced_total", "Health messages dropped as repeats within a batch", lambda: [((), ingress.coalesced)], kind="counter"),
+        Sampled("patron_publish_queue_depth", "Messages in flight or waiting to be published", lambda: [((), publisher.depth())]),
+        Sampled("patron_gui_queue_depth", "Tasks waiting for the GUI thread", lambda: [((), len(server_gui.queue))]),
+        Sampled("patron_gui_queue_max_depth", "Most tasks ever waiting for the GUI thread", lambda: guiStat("max_depth")),
+        Sampled("patron_gui_tasks_queued_total", "Tasks handed to the GUI thread", lambda: guiStat("queued"), kind="counter"),
+        Sampled("patron_gui_tasks_run_total", "Tasks run by the GUI thread", lambda: guiStat("ran"), kind="counter"),
+        Sampled("patron_gui_frames_carried_over_total", "GUI frames that ran out of budget with tasks left", lambda: guiStat("carried_over"), kind="counter"),
+        Sampled("patron_gui_drain_max_seconds", "Longest time the GUI thread spent running tasks in one frame", lambda: [((), ms / 1000) for _, ms in guiStat("max_drain_ms")]),
+        Sampled("patron_gui_view_pending", "Badge buttons waiting to be redrawn", lambda: [((), server_gui.view.pending())]),
+        Sampled("patron_badges_registered", "Badges registered", lambda: [((site.name,), len(site.registry)) for site in sites.values()], ("site",)),
+        Sampled("patron_badges", "Registered badges by status",
+                lambda: [((site.name, label), site.registry.count(status)) for site in sites.values() for label, status in statuses], ("site", "status")),
+        Sampled("patron_health_probes_in_flight", "Health probes waiting for an answer", lambda: [((site.name,), site.health_prober.in_flight()) for site in sites.values()], ("site",)),
+        Sampled("patron_pages_in_flight", "Page requests not yet finished", lambda: [((site.name,), len(site.paging.requests)) for site in sites.values()], ("site",)),
+    ):
+        metrics.REGISTRY.add(metric)
 
 #pageRequestFlag
-#tell the system that a page request as been made
-def pageRequestFlag():
-    global button_call_pressed
-    button_call_pressed = True
-
-
-def client_publish(client_id, command):
+#tell the system that a page request as been made. Each call starts its own
+#request; returns the request's correlation id. Requests without a site go to
+#the first site this process serves.
+def pageRequestFlag(kiosk_id=LOCAL_KIOSK, site_name=None):
+    site = sites[site_name] if site_name is not None else next(iter(sites.values()))
+    return site.paging.request(kiosk_id, time.time())
+
+#wakeService
+#Wake the service loop so it handles queued server messages immediately.
+#Safe to call from the GUI thread.
+def wakeService():
+    scheduler.wake()
+
+#stopService
+#Ask the service loop to finish its current pass and return, disconnecting
+#from the MQTT server. Safe to call from the GUI thread.
+def stopService():
+    global stopping
+    stopping = True
+    scheduler.wake()
+
+#client_publish
+#Send a command to a single client of a site. Returns right away with a future
+#that resolves once the message is on the socket (None if it could not be queued).
+def client_publish(client_id, command, site):
     if DEBUG_COMM:
         print(f"client_publish - command: {command}")
     try:
         msg = str(command)
-        if (client_sub):
-            pubMsg = client_sub.publish(
-                topic=str(client_id),
-                payload=msg.encode('utf-8'),
-                qos=0,
-            )
-            
-            pubMsg.wait_for_publish()
+        if (publisher):
+            return publisher.publish(site.topic(str(client_id)), msg.encode('utf-8'))
     except Exception as e:
         print(e)
+    return None
 
-def global_publish(command):
+#global_publish
+#Send a command, and any arguments it takes, to every client of a site
+def global_publish(command, site, *args):
     if DEBUG_COMM:
-        print(f"client/global publish - command: {command}")
+        print(f"{site.topic('client/global')} publish - command: {command}")
     try:
-        msg = str(command)
-        if (client_sub):
-            pubMsg = client_sub.publish(
-                topic="client/global",
-                payload=msg.encode('utf-8'),
-                qos=0,
-            )
-            
-            pubMsg.wait_for_publish()
+        msg = " ".join(str(part) for part in (command,) + args)
+        if (publisher):
+            return publisher.publish(site.topic("client/global"), msg.encode('utf-8'))
     except Exception as e:
         print(e)
+    return None
+
+#restoreRegistry
+#Load the site's badges from its journal. They come back ACTIVE but are health
+#checked straight away, spread over WARM_START_SPREAD, and drop out as usual if
+#they don't answer. Returns the number of badges restored.
+def restoreRegistry(site, now):
+    known = site.journal.load()
+    for index, (client_id, name) in enumerate(known):
+        lastPing = now - TIME_BETWEEN_PINGS + WARM_START_SPREAD * index / len(known)
+        record, is_new = site.registry.register(client_id, name, lastPing)
+        server_gui.view.update(record,'active')
+        trackLiveness(site, record, lastPing + TIME_BETWEEN_PINGS)
 
-# callNextReceiver
-# Sends out a pager request to the next client in the list.
-# If a person is going to be out on the 
-def callNextReceiver():
-    global current_client_id
-    global prev_client_id
-    global callRefusedFlag
-    global callAckFlag
-    global attempted_receivers
-
-    #Stop the receiver from calling if it was never refuseed
-    if (not callRefusedFlag):
-        client_publish(current_client_id, COMMAND_CANCEL)
-
-    callRefusedFlag = False
-    callAckFlag = False
-        
-    # Get list of keys
-    client_ids = list(registered_clients.keys())
-
-    # If current_client_id is not in list, start at the beginning
-    if current_client_id not in client_ids:
-        current_client_id = client_ids[0] if client_ids else None
-
-    # If there are no clients, or we have contacted all clients, return
-    if ((current_client_id is None) | (attempted_receivers == len(registered_clients))) :
-        return False
-
-    # Get current client_props
-    client_props = registered_clients[current_client_id]
-    
-    published = False
+    if DEBUG_COMM:
+        print(f"Restored {len(known)} clients for {site!r}")
+    return len(known)
 
-    #TODO Account for sending multiple commands
-    
-    client_publish(current_client_id, COMMAND_PAGE)
-    published = True
+#saveRegistry
+#Write the site's journal soon, changes made in the meantime go out together
+def saveRegistry(site):
+    if site.journalTimer is None and site.journal.pending:
+        site.journalTimer = scheduler.call_later(JOURNAL_FLUSH_INTERVAL, lambda: flushJournal(site))
 
+def flushJournal(site):
+    site.journalTimer = None
+    try:
+        site.journal.flush()
+    except OSError as e:
+        print(e)
+        saveRegistry(site)
+
+def flushJournalNow(site):
+    if site.journalTimer is not None:
+        site.journalTimer.cancel()
+    flushJournal(site)
+
+#scheduleHealthSweep
+#Arm the site's health sweep timer for the given deadline unless an earlier
+#sweep is already pending.
+def scheduleHealthSweep(site, deadline):
+    timer = site.healthSweepTimer
+    if timer is not None and not timer.cancelled:
+        if timer.deadline <= deadline:
+            return
+        timer.cancel()
+    site.healthSweepTimer = scheduler.call_at(deadline, lambda: healthSweep(site))
+
+#trackLiveness
+#Have the site's health sweep look at record again at due
+def trackLiveness(site, record, due):
+    site.liveness.schedule(record, due)
+    scheduleHealthSweep(site, due)
+
+#healthSweep
+#Scheduled event that checks the site's clients whose liveness deadline has passed
+#for health requests and status changes, then schedules itself for the next one due.
+def healthSweep(site):
+    sweepStart = time.perf_counter()
+    site.healthSweepTimer = None
+    registry = site.registry
+    liveness = site.liveness
+    health_prober = site.health_prober
 
-    # Find the next client_id in the list, or start at the beginning if at end
-    current_index = client_ids.index(current_client_id)
-    prev_client_id = current_client_id
-    next_index = (current_index + 1) % len(client_ids)
-    current_client_id = client_ids[next_index]
-    
-    attempted_receivers += 1
-
-    # Call the next receiver if this one fails
-    # If theres none left to call return false
-    if((published == False) & (attempted_receivers < len(registered_clients)) ):
-        return callNextReceiver()
-    elif (published == False):
-        server_gui.queue.put(lambda: server_gui.togglePager(False))
-        return False
+    currentTime = time.time()
+    probesSent = 0
+
+    # Only the clients that need attention come off the liveness index
+    if len(registry) > 0:
+        for record in liveness.pop_expired(currentTime):
+            client_id = record.client_id
+            lastPing = record.last_ping
+            if ((currentTime - lastPing) > CLIENT_STATUS_OFFLINE_TIME):
+                #Set status of the client to be offline
+                registry.set_status(record, CLIENT_STATUS_OFFLINE)
+
+                #Remove the client from the GUI interface
+                server_gui.view.remove(client_id)
+                health_prober.forget(client_id)
+                liveness.discard(record)
+                registry.remove(client_id)
+                site.journal.forget(client_id)
+                saveRegistry(site)
+                continue
+
+            if ((currentTime - lastPing) > CLIENT_STATUS_INACTIVE_TIME):
+                #Set status of the client to be inactive
+                if (record.status != CLIENT_STATUS_INACTIVE):
+                    registry.set_status(record, CLIENT_STATUS_INACTIVE)
+
+                    #Update client button GUI
+                    server_gui.view.update(record,'inactive')
+
+                due = lastPing + CLIENT_STATUS_OFFLINE_TIME
+            elif ((currentTime - lastPing) > TIME_BETWEEN_PINGS):
+                #Probe the client unless one is already out and not yet due for a retry
+                probeTime = health_prober.next_probe_time(client_id, lastPing + TIME_BETWEEN_PINGS)
+                if probeTime is not None and probeTime <= currentTime:
+                    if probesSent < HEALTH_SWEEP_PROBE_BUDGET:
+                        health_prober.send(client_id, currentTime)
+                        probesSent += 1
+                        probeTime = health_prober.next_probe_time(client_id, lastPing + TIME_BETWEEN_PINGS)
+                    else:
+                        probeTime = currentTime #Sweep budget spent, catch it on the next sweep
+
+                due = lastPing + CLIENT_STATUS_INACTIVE_TIME
+                if probeTime is not None:
+                    due = min(due, probeTime)
+            else:
+                due = lastPing + TIME_BETWEEN_PINGS #Sufficient time not yet elapsed
+
+            liveness.schedule(record, due)
     else:
-        return True
+        print(f"No clients registered at {site!r}")
 
-def toMillis(sec):
-    return sec*1000
+    nextDeadline = liveness.next_due()
+    if nextDeadline is not None:
+        scheduleHealthSweep(site, max(nextDeadline, currentTime + HEALTH_SWEEP_MIN_INTERVAL))
+    stageDone("health_sweep", sweepStart)
 
 #loop through cyclical operations
-def loop():
-    global currentState
-    global delayCounter
-    global callAckFlag
-    global callRefusedFlag
-    global attempted_receivers
+async def loop():
+    #Sleep until the next scheduled event is due or something wakes us up
+    await scheduler.wait()
+    WATCHDOG.enter("loop")
+    iterationStart = time.perf_counter()
+    scheduler.run_due()
+    stageStart = stageDone("timers", iterationStart)
 
     #Handle visuals
     while not server_gui.server_message_queue.empty():
         task=server_gui.server_message_queue.get()
         task()
-        
-    currentTime = time.time()
-    deltaTime = currentTime - previousTime
-
-    time.sleep(.2)
-    if (flag_connected != 1):
-        print("trying to connect MQTT server..")
-
-    # Loop through the registered devices in registered_client and check if we need to do
-    # a health check on any of them.
-    if len(registered_clients) > 0:
-        for client_id in list(registered_clients.keys()):  # Create a copy of the keys
-            client_props = registered_clients[client_id]
-            if not isinstance(client_props, dict):
-                print(f"Unexpected value for client {client_id}: {client_props}")
-                continue 
-
-            if ((currentTime - client_props['p']) > CLIENT_STATUS_OFFLINE_TIME):
-                #Set status of the client to be offline
-                client_props["s"] = CLIENT_STATUS_OFFLINE
+    stageStart = stageDone("gui_messages", stageStart)
 
-                #Remove the client from the GUI interface
-                server_gui.queue.put(lambda: server_gui.remove_client(client_id))
-                if registered_clients[client_id]:
-                    del registered_clients[client_id]
-                else:
-                    raise ValueError("ERROR: Could not find offline registered client")
-                continue
-
-            if ((currentTime - client_props['p']) > CLIENT_STATUS_INACTIVE_TIME):
-                #Set status of the client to be inactive
-                client_props["s"] = CLIENT_STATUS_INACTIVE
-
-                #Update client button GUI
-                server_gui.queue.put(lambda: server_gui.update_status(registered_clients[client_props["i"]],'inactive'))
-                
-                continue
-            if ((currentTime - client_props['p']) > TIME_BETWEEN_PINGS):
-                client_publish(client_id, COMMAND_HEALTH)
-            else:
-                pass #Sufficient time not yet elapsed
-    else:
-        print("No clients registered")
+    #Badge messages that came in since the last pass
+    drainIngress()
+    stageStart = stageDone("ingress", stageStart)
 
     #################
     # STATE MACHINE #
     #################
 
-    #Start state machine to handle the paging requests
-    if (currentState == ServerState.IDLE_STATE):
-        if (DEBUG_STATEMACHINE): 
-            print("IDLE_STATE")
-
-        global button_call_pressed
-        if (button_call_pressed):
-
-            attempted_receivers = 0
-            callRefusedFlag = True # To surpress the initial cancel command
-            callAckFlag = False
-
-            #Reset button pressed flag
-            button_call_pressed = False
-            
-            # Start the process of calling the clients
-            if ((len(registered_clients) > 0) & callNextReceiver()):
-                delayCounter = time.time()
-                #visual effects here to show the
-                #person pressing the button that we are thinking
-                #about it.
-                server_gui.queue.put(lambda: server_gui.togglePager(True))
-                currentState = ServerState.CALLING_STATE
-            else:
-                delayCounter = time.time()
-                #No help visual (Only needs to be called once)
-                server_gui.queue.put(lambda: server_gui.response_disp(True,"no_help"))
-                currentState = ServerState.NO_HELP_STATE
-
-    elif (currentState == ServerState.CALLING_STATE):
-        if DEBUG_STATEMACHINE: 
-            print("CALLING_STATE")
-
-        # if the page has been acknowledged, we're good to go.
-        if (callAckFlag):
-            #Go through each of the clients to see which one has acknowledged
-            #Then go through and see if they accepted or rejected
-            currentState = ServerState.ACKED_STATE
-            delayCounter = time.time()
-            callAckFlag = 0
-
-            #Update display to show that pager call was achknowledged
-        elif (((toMillis(currentTime) - toMillis(delayCounter)) >= WAIT_TIME_MS) | callRefusedFlag | ((currentTime - registered_clients[prev_client_id]["p"]) > CLIENT_STATUS_INACTIVE_TIME)):
-            #Check to see if it was the client that refused the call for aid
-            if (((currentTime - registered_clients[prev_client_id]["p"]) < CLIENT_STATUS_INACTIVE_TIME)):
-                #Log the fact that a given client has said NO
-                if DEBUG_STATEMACHINE:
-                    print("CLIENT SAID NO")
-
-            #Check to see if there is someone else
-            if (callNextReceiver()):
-                delayCounter = time.time()
-            else:
-                server_gui.queue.put(lambda: server_gui.response_disp(True,"no_help"))
-                delayCounter = time.time()
-                currentState = ServerState.REFUSED_STATE
-
-    elif (currentState == ServerState.NO_HELP_STATE):
-        if DEBUG_STATEMACHINE: 
-            print("NO_HELP_STATE")
-
-        # print((currentTime - delayCounter))
-        if ((toMillis(currentTime) - toMillis(delayCounter)) >= ERROR_BLINK_MS):
-            #Enable ping button
-            server_gui.queue.put(lambda: server_gui.togglePager(False))
-            currentState = ServerState.IDLE_STATE
-
-    elif ((currentState == ServerState.ACKED_STATE) | (currentState == ServerState.REFUSED_STATE)):
-        if DEBUG_STATEMACHINE: 
-            print("ACKED/REFUSED_STATE")
-        server_gui.queue.put(lambda: server_gui.togglePager(False))
-        currentState = ServerState.IDLE_STATE
-
-    else:#This should not ever happen
-        if DEBUG_STATEMACHINE: 
-            print("Default state triggered")
-    
-def runStartup(gui):
-    global server_gui 
+    #Step the state machine of every page request in flight
+    currentTime = time.time()
+    for site in sites.values():
+        site.paging.step(currentTime)
+    stageDone("state_machine", stageStart)
+
+    LOOP_ITERATION_SECONDS.observe(time.perf_counter() - iterationStart)
+    WATCHDOG.leave("loop")
+
+#stageDone
+#Record the time a loop stage took since start, returns the end time as the
+#start of the next stage
+def stageDone(stage, start):
+    end = time.perf_counter()
+    LOOP_STAGE_SECONDS.observe(end - start, stage)
+    return end
+
+#runService
+#Service entry point on the event loop
+async def runService(site_names, client_name):
+    scheduler.attach(asyncio.get_running_loop())
+    setup(site_names, client_name)
+
+    while not stopping:
+        await loop()
+
+    client_sub.disconnect()
+
+#openAnalytics
+#Opens the analytics log for the named sites with the page time series fed
+#from it, and starts its writer
+def openAnalytics(name):
+    global analytics, pages
+    analytics = AnalyticsLog(*analytics_paths(name))
+    pages = PageStore(page_store_path(name))
+    analytics.add_listener(pages)
+    analytics.start()
+    return analytics
+
+#The GUI opens the analytics first when it runs in this process, otherwise
+#the service opens its own
+def runStartup(gui, site_names=LOCAL_SITES, client_name=MQTT_CLIENT_ID, metrics_port=METRICS_PORT):
+    global server_gui
     server_gui = gui
-    setup()
-
-    while True:
-        loop()
\ No newline at end of file
+    if analytics is None:
+        openAnalytics(group_name(site_names))
+    metrics.serve(metrics_port)
+    WATCHDOG.start()
+    if tracing.TRACE_PAGES:
+        tracing.enable(tracing.trace_path(group_name(site_names)))
+
+    #add_reader/add_writer need a selector based event loop on Windows
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    asyncio.run(runService(site_names, client_name))
+
+#runWorker
+#Entry point of a worker process serving site_names without a GUI
+def runWorker(site_names, metrics_port):
+    install_signals()
+    runStartup(HeadlessGUI(), site_names, MQTT_CLIENT_ID + "-" + group_name(site_names), metrics_port)
+
+#startWorkers
+#Start a worker process for every group of sites in WORKER_SITES. Each serves
+#its metrics on the next port after METRICS_PORT.
+def startWorkers():
+    workers = []
+    for index, site_names in enumerate(WORKER_SITES):
+        worker = multiprocessing.Process(target=runWorker, args=(site_names, METRICS_PORT + 1 + index), daemon=True)
+        worker.start()
+        workers.append(worker)
+    return workers
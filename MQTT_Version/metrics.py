@@ -0,0 +1,192 @@
+#Metrics - Patron Handler Service
+#Counters and histograms for where time goes in the service (paging, publishing,
+#the event loop) plus queue depths and badge counts sampled when scraped. They
+#are served on a local HTTP endpoint in the Prometheus text format:
+#
+#    curl http://127.0.0.1:9108/metrics
+#
+#Other modules can serve plain text pages from the same endpoint with
+#add_route, e.g. the profiling commands in profiling.py.
+#
+#Histograms use fixed log spaced buckets, each twice the one before, so one
+#set of buckets covers milliseconds to a minute. Observing is a bisect and two
+#additions under a lock, cheap enough for the service loop.
+
+import bisect
+import http.server
+import threading
+import urllib.parse
+
+DEBUG_METRICS = False
+
+METRICS_HOST = "127.0.0.1" #Local only
+METRICS_PORT = 9108 #Worker processes use the ports after this one
+
+def log_buckets(start, count, factor=2):
+    return tuple(start * factor ** index for index in range(count))
+
+LATENCY_BUCKETS = log_buckets(0.001, 17) #1ms to 65s
+LOOP_BUCKETS = log_buckets(0.0001, 16) #0.1ms to 3.3s
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {} #label values -> count
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name + format_labels(self.labelnames, labels), value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {} #label values -> [count per bucket + overflow, sum]
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield self.name + "_bucket" + format_labels(self.labelnames, labels, f'le="{format_value(bound)}"'), cumulative
+            yield self.name + "_sum" + format_labels(self.labelnames, labels), total
+            yield self.name + "_count" + format_labels(self.labelnames, labels), cumulative
+
+#A gauge (or counter kept elsewhere) read when scraped. sample returns
+#[(label values, value)].
+class Sampled:
+    def __init__(self, name, description, sample, labelnames=(), kind="gauge"):
+        self.name = name
+        self.description = description
+        self.sample = sample
+        self.labelnames = labelnames
+        self.kind = kind
+
+    def samples(self):
+        for labels, value in self.sample():
+            yield self.name + format_labels(self.labelnames, labels), value
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {} #name -> metric, in registration order
+
+    # Register a metric, replacing any of the same name (e.g. a sampled gauge
+    # set up again by a restarted service)
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, value in metric.samples():
+                    lines.append(f"{name} {format_value(value)}")
+            except Exception as e:
+                #A sampled value whose owner is mid-update, try again next scrape
+                if DEBUG_METRICS:
+                    print(f"Metrics -- {metric.name} failed: {e}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+###########
+# SERVICE #
+###########
+
+PAGE_REQUESTS = REGISTRY.add(Counter("patron_page_requests_total", "Page requests started", ("site",)))
+PAGE_OUTCOMES = REGISTRY.add(Counter("patron_page_outcomes_total", "Page requests finished, by outcome", ("site", "outcome")))
+PAGE_FIRST_PAGE_SECONDS = REGISTRY.add(Histogram("patron_page_first_page_seconds", "Time from a page request to the first badge being paged", labelnames=("site",)))
+PAGE_ACCEPT_SECONDS = REGISTRY.add(Histogram("patron_page_accept_seconds", "Time from a page request to a badge accepting it", labelnames=("site",)))
+PUBLISH_SECONDS = REGISTRY.add(Histogram("patron_publish_seconds", "Time from handing a message to paho to it reaching the socket"))
+PUBLISH_ERRORS = REGISTRY.add(Counter("patron_publish_errors_total", "Messages that failed to publish or were dropped"))
+LOOP_LAG_SECONDS = REGISTRY.add(Histogram("patron_loop_lag_seconds", "How late scheduled timers ran", LOOP_BUCKETS))
+LOOP_ITERATION_SECONDS = REGISTRY.add(Histogram("patron_loop_iteration_seconds", "Time spent in one pass of the service loop", LOOP_BUCKETS))
+GUI_DRAIN_SECONDS = REGISTRY.add(Histogram("patron_gui_drain_seconds", "Time the Tk thread spent running queued GUI tasks in one frame", LOOP_BUCKETS))
+LOOP_STAGE_SECONDS = REGISTRY.add(Histogram("patron_loop_stage_seconds", "Time spent in each stage of a service loop pass, health_sweep is part of timers", LOOP_BUCKETS, ("stage",)))
+
+#################
+# HTTP ENDPOINT #
+#################
+
+#path -> handler(query), returning the page text. Handlers run on the HTTP
+#server's threads.
+ROUTES = {
+    "/": lambda query: REGISTRY.render(),
+    "/metrics": lambda query: REGISTRY.render(),
+}
+
+def add_route(path, handler):
+    ROUTES[path] = handler
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        handler = ROUTES.get(url.path)
+        if handler is None:
+            self.send_error(404)
+            return
+        body = handler(dict(urllib.parse.parse_qsl(url.query))).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if DEBUG_METRICS:
+            super().log_message(format, *args)
+
+# Serve the metrics from a background thread. Returns the server, or None if
+# the port couldn't be bound (the service runs on without metrics).
+def serve(port=METRICS_PORT, host=METRICS_HOST):
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print(f"Metrics endpoint not started on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    if DEBUG_METRICS:
+        print(f"Metrics -- serving on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,70 @@
+#MQTT asyncio bridge - Patron Handler Service
+#Drives the paho client's socket from an asyncio event loop instead of paho's
+#network thread. Message callbacks, timers and publishes all run on the same
+#loop, so the service state never crosses threads.
+#
+#The one exception is reconnecting, which blocks on the TCP connect and so
+#runs on an executor thread (see reconnectBroker in main.py). The socket hooks
+#paho calls from there are handed over to the event loop.
+
+import asyncio
+import threading
+import paho.mqtt.client as mqtt
+
+DEBUG_MQTT_ASYNC = False
+
+#Seconds between paho housekeeping calls (keepalive pings, retries)
+MISC_INTERVAL = 1
+
+class AsyncioHelper:
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.thread = threading.get_ident() #The event loop's thread
+
+        #Link paho's external event loop hooks
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    # Run a socket hook on the event loop, now if paho called it from there
+    def _on_loop(self, hook, *args):
+        if threading.get_ident() == self.thread:
+            hook(*args)
+        else:
+            self.loop.call_soon_threadsafe(hook, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._on_loop(self._socket_open, client, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._on_loop(self._socket_close, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_writer, sock)
+
+    def _socket_open(self, client, sock):
+        if DEBUG_MQTT_ASYNC:
+            print("MQTT -- socket opened")
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def _socket_close(self, sock):
+        if DEBUG_MQTT_ASYNC:
+            print("MQTT -- socket closed")
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(MISC_INTERVAL)
+            except asyncio.CancelledError:
+                break
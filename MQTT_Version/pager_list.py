@@ -0,0 +1,140 @@
+#Pager list - Patron Handler GUI
+#Scrolling list of badge buttons. Only the rows that fit on screen have a
+#widget: a fixed pool of buttons is laid out once and rebound to whichever
+#badges are scrolled into view. Adding, removing or recoloring a badge only
+#reconfigures the visible rows it affects, there is no re-layout of the list.
+
+import tkinter as tk
+
+PAGER_LIST_ROWS = 10 #Rows on screen at once
+
+class PagerList:
+    def __init__(self, parent, on_click, font, rows=PAGER_LIST_ROWS, colors=None):
+        self.on_click = on_click
+        self.font = font
+        self.rows = rows
+        self.colors = colors or {}
+
+        self.frame = tk.Frame(parent)
+        self.rows_frame = tk.Frame(self.frame)
+        self.rows_frame.grid(row=0, column=0, sticky='nsew')
+        self.scrollbar = tk.Scrollbar(self.frame, orient='vertical', command=self._on_scroll)
+        self.scrollbar.grid(row=0, column=1, sticky='ns')
+        for widget in (self.frame, self.rows_frame):
+            widget.bind("<MouseWheel>", self._on_wheel)
+            widget.bind("<Button-4>", lambda event: self.scroll_to(self.first - 1))
+            widget.bind("<Button-5>", lambda event: self.scroll_to(self.first + 1))
+
+        self.order = [] #client_ids top to bottom
+        self.views = {} #client_id -> ClientView
+        self.first = 0 #Index of the top visible row
+        self.pool = [] #One button per visible row, made as needed
+        self.shown = [] #(client_id, name, color) each pooled button shows, None if hidden
+
+    def grid(self, **kwargs):
+        self.frame.grid(**kwargs)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, client_id):
+        return client_id in self.views
+
+    # Add a badge at the bottom of the list
+    def insert(self, client_id, view):
+        self.views[client_id] = view
+        self.order.append(client_id)
+        self._refresh_rows(len(self.order) - 1)
+        self._update_scrollbar()
+
+    # Only a visible row needs redrawing, the rest pick the view up on scroll
+    def update(self, client_id, view):
+        self.views[client_id] = view
+        for row, state in enumerate(self.shown):
+            if (state is not None) and (state[0] == client_id):
+                self._refresh_row(row)
+                return
+
+    def remove(self, client_id):
+        if self.views.pop(client_id, None) is None:
+            return
+        index = self.order.index(client_id)
+        del self.order[index]
+
+        #Keep the window full when the end of the list is on screen
+        if self.first > max(0, len(self.order) - self.rows):
+            self.first = max(0, len(self.order) - self.rows)
+            index = self.first
+        self._refresh_rows(index)
+        self._update_scrollbar()
+
+    def scroll_to(self, first):
+        first = max(0, min(first, len(self.order) - self.rows))
+        if first == self.first:
+            return
+        self.first = first
+        self._refresh_rows(first)
+        self._update_scrollbar()
+
+    # Rebind the visible rows from list index start on, count of them or all
+    # the way to the bottom of the window
+    def _refresh_rows(self, start, count=None):
+        first = max(start, self.first) - self.first
+        last = self.rows if count is None else min(self.rows, start - self.first + count)
+        for row in range(first, last):
+            self._refresh_row(row)
+
+    def _refresh_row(self, row):
+        while len(self.pool) <= row:
+            self._add_pool_button()
+
+        index = self.first + row
+        button = self.pool[row]
+        if index >= len(self.order):
+            if self.shown[row] is not None:
+                button.grid_remove()
+                self.shown[row] = None
+            return
+
+        client_id = self.order[index]
+        view = self.views[client_id]
+        state = (client_id, view.name, self.colors.get(view.status, 'red'))
+        if self.shown[row] == state:
+            return
+        if self.shown[row] is None:
+            button.grid()
+        button.config(text=state[1], bg=state[2])
+        self.shown[row] = state
+
+    def _add_pool_button(self):
+        row = len(self.pool)
+        button = tk.Button(self.rows_frame, font=self.font, command=lambda: self._clicked(row))
+        button.grid(row=row, column=0, padx=5, pady=5, sticky='ew')
+        button.grid_remove()
+        button.bind("<MouseWheel>", self._on_wheel)
+        button.bind("<Button-4>", lambda event: self.scroll_to(self.first - 1))
+        button.bind("<Button-5>", lambda event: self.scroll_to(self.first + 1))
+        self.pool.append(button)
+        self.shown.append(None)
+
+    def _clicked(self, row):
+        if self.shown[row] is not None:
+            self.on_click(self.views[self.shown[row][0]].record)
+
+    def _update_scrollbar(self):
+        total = len(self.order)
+        if total <= self.rows:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.first / total, (self.first + self.rows) / total)
+
+    #Scrollbar commands: ('moveto', fraction) or ('scroll', n, 'units'/'pages')
+    def _on_scroll(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.scroll_to(round(float(amount) * len(self.order)))
+        elif action == 'scroll':
+            step = self.rows if unit == 'pages' else 1
+            self.scroll_to(self.first + int(amount) * step)
+
+    def _on_wheel(self, event):
+        self.scroll_to(self.first - (1 if event.delta > 0 else -1))
@@ -0,0 +1,343 @@
+#Paging - Patron Handler Service
+#Every page request gets its own PageRequest running the paging state machine,
+#so patrons at several kiosks can be paged for at the same time. Requests are
+#identified by a request_id. Badges don't echo it back, so a badge's answer is
+#routed to whichever request it is ringing for. A badge that is ringing for one
+#request, or has just accepted one, is left out of the others.
+
+import collections
+import time
+import uuid
+from enum import Enum
+
+from registry import CLIENT_STATUS_ACTIVE, RESPONSE_ACCEPT, RESPONSE_DENY
+from gui_tasks import PRIORITY_RESPONSE, PRIORITY_INDICATOR
+from analytics import EVENT_REQUEST, EVENT_ATTEMPT, EVENT_ACCEPT, EVENT_DENY, EVENT_TIMEOUT, EVENT_CANCEL, EVENT_NO_HELP
+from metrics import PAGE_REQUESTS, PAGE_OUTCOMES, PAGE_FIRST_PAGE_SECONDS, PAGE_ACCEPT_SECONDS
+from tracing import start_trace
+
+DEBUG_STATEMACHINE = False
+
+#State machine variables
+class ServerState(Enum):
+    IDLE_STATE = 0
+    CALLING_STATE = 1
+    NO_HELP_STATE = 2
+    ACKED_STATE = 3
+    REFUSED_STATE = 4
+
+#ServerState machine timing values
+MILLIS_TO_SEC = 1000
+WAIT_TIME_MS = 8000
+ERROR_BLINK_MS = 1000
+STATUS_DISPLAY_MS = 2000
+
+#Ring group paging
+#A page rings PAGE_GROUP_SIZE badges at once. Every PAGE_STAGE_MS without an
+#answer the group widens by PAGE_GROUP_GROWTH badges. Each badge rings for at
+#most WAIT_TIME_MS and the first RESPONSE_ACCEPT cancels the rest.
+#The defaults page one badge at a time.
+PAGE_GROUP_SIZE = 1
+PAGE_GROUP_GROWTH = 0
+PAGE_STAGE_MS = WAIT_TIME_MS
+
+#Order receivers are tried in: 'ranked' tries the badges that usually accept
+#quickly first (see ranking.py), 'round_robin' just follows the rotation
+RECEIVER_ORDER = 'ranked'
+
+#How long a badge that accepted a page is kept out of other requests
+ACCEPT_BUSY_MS = 30000
+
+def toMillis(sec):
+    return sec*1000
+
+class PageRequest:
+    def __init__(self, engine, request_id, kiosk_id, now, trace):
+        self.engine = engine
+        self.request_id = request_id
+        self.kiosk_id = kiosk_id
+        self.created = now
+        self.trace = trace #See tracing.py
+
+        self.currentState = ServerState.IDLE_STATE
+        self.finished = False
+        self.callAckFlag = False
+        self.callRefusedFlag = False
+        self.acceptedClient = None
+        self.attempted_receivers = set()
+        self.ringing_receivers = {} #client_id -> time the page was sent
+        self.ranked_receivers = collections.deque() #Candidates, best first
+        self.ringTarget = PAGE_GROUP_SIZE
+        self.stageCounter = now
+        self.delayCounter = now
+        self.stateTimer = None
+        self.trace.begin("state", state=self.currentState.name)
+
+    # A badge ringing for this request answered. received is when the answer
+    # came off the socket.
+    def response(self, record, response, now, received=None):
+        self.trace.span("response", now if received is None else received, time.time(), c=record.client_id, response=response)
+        if self.callAckFlag:
+            return
+        responseTime = now - self.ringing_receivers[record.client_id]
+        gui = self.engine.gui
+
+        if (response == RESPONSE_ACCEPT):
+            if DEBUG_STATEMACHINE:
+                print(f"{self.request_id} -- {record.client_id} accepted")
+            self.engine.ranker.record_accept(record.client_id, responseTime)
+            self.engine.log(EVENT_ACCEPT, r=self.request_id, c=record.client_id, l=round(responseTime, 3))
+            PAGE_ACCEPT_SECONDS.observe(now - self.created, self.engine.site_name)
+            PAGE_OUTCOMES.inc(self.engine.site_name, "accept")
+            self.trace.end("attempt", record.client_id, outcome="accept")
+            self.callAckFlag = True
+            self.acceptedClient = record.client_id
+            gui.view.update(record,'active')
+            gui.queue.put(lambda: gui.response_disp(True,"page_accept", record), PRIORITY_RESPONSE)
+        elif (response == RESPONSE_DENY):
+            if DEBUG_STATEMACHINE:
+                print(f"{self.request_id} -- {record.client_id} denied")
+            self.engine.ranker.record_refusal(record.client_id, responseTime, now)
+            self.engine.log(EVENT_DENY, r=self.request_id, c=record.client_id, l=round(responseTime, 3))
+            self.trace.end("attempt", record.client_id, outcome="deny")
+            self.callRefusedFlag = True
+            self.stopRinging(record.client_id)
+
+    # nextCandidate
+    # Best ranked receiver not yet tried on this page. Falls back to the rotation
+    # for badges that registered after the page started.
+    def nextCandidate(self):
+        engine = self.engine
+        while self.ranked_receivers:
+            record = self.ranked_receivers.popleft()
+            if ((record.client_id not in self.attempted_receivers) & engine.available(record.client_id)):
+                engine.registry.rotate_past(record)
+                return record
+        return engine.registry.next_receiver(
+            lambda record: (record.client_id in self.attempted_receivers) | engine.engaged(record.client_id))
+
+    # callNextReceiver
+    # Sends out a pager request to the next receiver and adds it to the ring group.
+    # Returns False once every available client has been tried.
+    def callNextReceiver(self):
+        receiver = self.nextCandidate()
+        if receiver is None:
+            return False
+
+        if not self.attempted_receivers:
+            PAGE_FIRST_PAGE_SECONDS.observe(time.time() - self.created, self.engine.site_name)
+        self.trace.publish(self.engine.page_client(receiver.client_id), c=receiver.client_id, command="page")
+        self.trace.begin("attempt", receiver.client_id, c=receiver.client_id)
+        self.engine.log(EVENT_ATTEMPT, r=self.request_id, c=receiver.client_id, b=receiver.name)
+        self.ringing_receivers[receiver.client_id] = time.time()
+        self.attempted_receivers.add(receiver.client_id)
+        self.engine.ringing[receiver.client_id] = self
+        return True
+
+    # fillRingGroup
+    # Page more receivers until ringTarget badges are ringing or nobody is left
+    def fillRingGroup(self):
+        while (len(self.ringing_receivers) < self.ringTarget):
+            if (not self.callNextReceiver()):
+                return
+
+    def stopRinging(self, client_id):
+        self.ringing_receivers.pop(client_id, None)
+        if self.engine.ringing.get(client_id) is self:
+            del self.engine.ringing[client_id]
+
+    # cancelReceiver
+    # Stop a badge from ringing, outcome is why for the trace
+    def cancelReceiver(self, client_id, outcome):
+        self.trace.publish(self.engine.cancel_client(client_id), c=client_id, command="cancel")
+        self.trace.end("attempt", client_id, outcome=outcome)
+        self.stopRinging(client_id)
+
+    def setState(self, state):
+        self.trace.end("state")
+        self.currentState = state
+        self.trace.begin("state", state=state.name)
+
+    #armStateTimer
+    #Wake the state machine once delay_ms has elapsed, replacing any pending timeout
+    def armStateTimer(self, delay_ms):
+        if self.stateTimer is not None:
+            self.stateTimer.cancel()
+        self.stateTimer = self.engine.scheduler.call_later(delay_ms / MILLIS_TO_SEC, lambda: None)
+
+    # armRingTimer
+    # Wake the state machine when the next ringing badge times out or the stage ends
+    def armRingTimer(self):
+        deadline = min(self.ringing_receivers.values()) + WAIT_TIME_MS / MILLIS_TO_SEC
+        if (PAGE_GROUP_GROWTH > 0):
+            deadline = min(deadline, self.stageCounter + PAGE_STAGE_MS / MILLIS_TO_SEC)
+        self.armStateTimer(toMillis(max(0, deadline - time.time())))
+
+    # Run the state machine for this request once
+    def step(self, currentTime):
+        engine = self.engine
+        gui = engine.gui
+
+        if (self.currentState == ServerState.IDLE_STATE):
+            if (DEBUG_STATEMACHINE):
+                print(f"{self.request_id} -- IDLE_STATE")
+
+            self.stageCounter = currentTime
+            if (RECEIVER_ORDER == 'ranked'):
+                self.ranked_receivers.extend(engine.ranker.order(engine.registry.rotation(), currentTime))
+
+            # Start the process of calling the clients
+            self.fillRingGroup()
+            self.delayCounter = time.time()
+            if (self.ringing_receivers):
+                self.setState(ServerState.CALLING_STATE)
+                self.armRingTimer()
+            else:
+                #No help visual (Only needs to be called once)
+                gui.queue.put(lambda: gui.response_disp(True,"no_help"), PRIORITY_RESPONSE)
+                engine.log(EVENT_NO_HELP, r=self.request_id)
+                PAGE_OUTCOMES.inc(engine.site_name, "no_help")
+                self.setState(ServerState.NO_HELP_STATE)
+                self.armStateTimer(ERROR_BLINK_MS)
+
+        elif (self.currentState == ServerState.CALLING_STATE):
+            if DEBUG_STATEMACHINE:
+                print(f"{self.request_id} -- CALLING_STATE")
+
+            # if the page has been acknowledged, we're good to go.
+            if (self.callAckFlag):
+                #First accept wins, stop the rest of the ring group
+                for client_id in list(self.ringing_receivers):
+                    if (client_id != self.acceptedClient):
+                        engine.log(EVENT_CANCEL, r=self.request_id, c=client_id)
+                        self.cancelReceiver(client_id, "cancelled")
+                self.stopRinging(self.acceptedClient)
+                engine.busy_until[self.acceptedClient] = currentTime + ACCEPT_BUSY_MS / MILLIS_TO_SEC
+
+                self.setState(ServerState.ACKED_STATE)
+                self.delayCounter = time.time()
+                self.armStateTimer(0)
+            else:
+                if (self.callRefusedFlag):
+                    #Log the fact that a given client has said NO
+                    if DEBUG_STATEMACHINE:
+                        print(f"{self.request_id} -- CLIENT SAID NO")
+                    self.callRefusedFlag = False
+
+                #Stop badges that rang out or went inactive
+                for client_id, pagedTime in list(self.ringing_receivers.items()):
+                    if (((toMillis(currentTime) - toMillis(pagedTime)) >= WAIT_TIME_MS) | (not engine.receiverActive(client_id))):
+                        engine.ranker.record_timeout(client_id)
+                        engine.log(EVENT_TIMEOUT, r=self.request_id, c=client_id)
+                        self.cancelReceiver(client_id, "timeout")
+
+                #Widen the ring group once the stage is over
+                if ((PAGE_GROUP_GROWTH > 0) & ((toMillis(currentTime) - toMillis(self.stageCounter)) >= PAGE_STAGE_MS)):
+                    self.ringTarget += PAGE_GROUP_GROWTH
+                    self.stageCounter = currentTime
+
+                #Check to see if there is someone else
+                self.fillRingGroup()
+                if (self.ringing_receivers):
+                    self.armRingTimer()
+                else:
+                    gui.queue.put(lambda: gui.response_disp(True,"no_help"), PRIORITY_RESPONSE)
+                    engine.log(EVENT_NO_HELP, r=self.request_id)
+                    PAGE_OUTCOMES.inc(engine.site_name, "no_help")
+                    self.delayCounter = time.time()
+                    self.setState(ServerState.REFUSED_STATE)
+                    self.armStateTimer(0)
+
+        elif (self.currentState == ServerState.NO_HELP_STATE):
+            if DEBUG_STATEMACHINE:
+                print(f"{self.request_id} -- NO_HELP_STATE")
+
+            if ((toMillis(currentTime) - toMillis(self.delayCounter)) >= ERROR_BLINK_MS):
+                self.setState(ServerState.IDLE_STATE)
+                self.finished = True
+
+        elif ((self.currentState == ServerState.ACKED_STATE) | (self.currentState == ServerState.REFUSED_STATE)):
+            if DEBUG_STATEMACHINE:
+                print(f"{self.request_id} -- ACKED/REFUSED_STATE")
+            self.setState(ServerState.IDLE_STATE)
+            self.finished = True
+
+        else:#This should not ever happen
+            if DEBUG_STATEMACHINE:
+                print(f"{self.request_id} -- Default state triggered")
+
+class PagingEngine:
+    def __init__(self, registry, ranker, scheduler, page_client, cancel_client, gui, analytics=None, site_name=''):
+        self.registry = registry
+        self.ranker = ranker
+        self.scheduler = scheduler
+        self.page_client = page_client
+        self.cancel_client = cancel_client
+        self.gui = gui
+        self.analytics = analytics #Page lifecycle events, see analytics.py
+        self.site_name = site_name
+
+        self.requests = {} #request_id -> PageRequest, oldest first
+        self.ringing = {} #client_id -> PageRequest the badge is ringing for
+        self.busy_until = {} #client_id -> time a badge that accepted is free again
+        self.paging = False #Whether the GUI is showing the paging indicator
+
+    # Start paging for a patron. Returns the request's correlation id.
+    def request(self, kiosk_id, now):
+        request_id = uuid.uuid4().hex[:12]
+        trace = start_trace(request_id, site=self.site_name, kiosk=kiosk_id)
+        self.requests[request_id] = PageRequest(self, request_id, kiosk_id, now, trace)
+        self.log(EVENT_REQUEST, r=request_id, k=kiosk_id, s=self.site_name)
+        PAGE_REQUESTS.inc(self.site_name)
+        if DEBUG_STATEMACHINE:
+            print(f"{request_id} -- page requested by {kiosk_id}")
+        return request_id
+
+    def log(self, kind, **fields):
+        if self.analytics is not None:
+            self.analytics.record(kind, **fields)
+
+    # Route a badge's answer to the request it is ringing for. Returns False if
+    # the badge wasn't ringing for anything (late or stray answer).
+    def on_response(self, record, response, now, received=None):
+        request = self.ringing.get(record.client_id)
+        if request is None:
+            return False
+        request.response(record, response, now, received)
+        return True
+
+    #receiverActive
+    #True while the client is registered and has not gone inactive
+    def receiverActive(self, client_id):
+        record = self.registry.get(client_id)
+        return (record is not None) and (record.status == CLIENT_STATUS_ACTIVE)
+
+    # True if the badge is ringing for a request or still handling one it accepted
+    def engaged(self, client_id):
+        if client_id in self.ringing:
+            return True
+        busyUntil = self.busy_until.get(client_id)
+        if busyUntil is None:
+            return False
+        if busyUntil > time.time():
+            return True
+        del self.busy_until[client_id]
+        return False
+
+    def available(self, client_id):
+        return self.receiverActive(client_id) and not self.engaged(client_id)
+
+    # Run every request's state machine once
+    def step(self, currentTime):
+        for request in list(self.requests.values()):
+            request.step(currentTime)
+            if request.finished:
+                del self.requests[request.request_id]
+                request.trace.end("state")
+                request.trace.finish(accepted=request.acceptedClient, attempts=len(request.attempted_receivers))
+
+        #Show the paging indicator while any request is still calling
+        paging = any(request.currentState == ServerState.CALLING_STATE for request in self.requests.values())
+        if paging != self.paging:
+            self.paging = paging
+            self.gui.queue.put(lambda: self.gui.togglePager(paging), PRIORITY_INDICATOR)
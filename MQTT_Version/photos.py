@@ -0,0 +1,97 @@
+#Staff photos - Patron Handler GUI
+#Finds the photo for a badge, decodes it the first time it is shown and keeps
+#the scaled thumbnail in a bounded LRU cache, so clicking through the roster
+#doesn't decode the same file twice or hold every photo in memory.
+#
+#A badge's photo is PHOTO_DIR/<client id>.<ext> (colons replaced by '-') or,
+#failing that, PHOTO_DIR/<badge name>.<ext>. Pillow is used when installed,
+#which adds JPEG support; otherwise Tk's own PNG/GIF loader is used.
+
+import collections
+import math
+import os
+import tkinter as tk
+
+try:
+    from PIL import Image, ImageTk
+except ImportError:
+    Image = None
+
+DEBUG_PHOTOS = False
+
+PHOTO_DIR = "Lib"
+PHOTO_SIZE = 200 #Longest side of a thumbnail in pixels
+PHOTO_CACHE_SIZE = 64 #Thumbnails kept decoded
+
+if Image is not None:
+    PHOTO_EXTENSIONS = (".png", ".gif", ".jpg", ".jpeg")
+else:
+    PHOTO_EXTENSIONS = (".png", ".gif")
+
+class PhotoCache:
+    def __init__(self, photo_dir=PHOTO_DIR, size=PHOTO_SIZE, capacity=PHOTO_CACHE_SIZE):
+        self.photo_dir = photo_dir
+        self.size = size
+        self.capacity = capacity
+        self._thumbnails = collections.OrderedDict() #path -> PhotoImage, least recent first
+        self._files = None #Lowercase file name -> file name in photo_dir
+        self.hits = 0
+        self.misses = 0
+
+    # Thumbnail for the badge, or None if it has no photo. Tk thread only.
+    def thumbnail(self, record):
+        path = self._find(record)
+        if path is None:
+            return None
+
+        photo = self._thumbnails.get(path)
+        if photo is not None:
+            self.hits += 1
+            self._thumbnails.move_to_end(path)
+            return photo
+
+        self.misses += 1
+        try:
+            photo = self._decode(path)
+        except (OSError, tk.TclError) as e:
+            print(f"Could not load photo {path}: {e}")
+            return None
+
+        self._thumbnails[path] = photo
+        if len(self._thumbnails) > self.capacity:
+            self._thumbnails.popitem(last=False)
+        if DEBUG_PHOTOS:
+            print(f"Photos -- decoded {path}, {len(self._thumbnails)} cached")
+        return photo
+
+    # Forget the directory listing, e.g. after photos were added
+    def rescan(self):
+        self._files = None
+
+    def _find(self, record):
+        if self._files is None:
+            try:
+                self._files = {name.lower(): name for name in os.listdir(self.photo_dir)}
+            except OSError:
+                self._files = {}
+
+        for stem in (record.client_id.replace(':', '-'), record.name):
+            for extension in PHOTO_EXTENSIONS:
+                name = self._files.get((stem + extension).lower())
+                if name is not None:
+                    return os.path.join(self.photo_dir, name)
+        return None
+
+    def _decode(self, path):
+        if Image is not None:
+            with Image.open(path) as image:
+                #Let JPEG decode at a reduced scale instead of full size
+                image.draft("RGB", (self.size, self.size))
+                image.thumbnail((self.size, self.size))
+                return ImageTk.PhotoImage(image)
+
+        photo = tk.PhotoImage(file=path)
+        factor = math.ceil(max(photo.width(), photo.height()) / self.size)
+        if factor > 1:
+            photo = photo.subsample(factor, factor)
+        return photo
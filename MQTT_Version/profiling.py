@@ -0,0 +1,224 @@
+#Profiling and stall watchdog - Patron Handler Service
+#Two tools for finding out where the service or GUI is stuck or slow, both
+#safe to use on a running system.
+#
+#The stack sampler records every thread's stack (service loop, Tk, analytics
+#writer...) every PROFILE_INTERVAL while it runs and writes the counts in
+#folded format (one "thread;file:function;... count" line per stack, what
+#flamegraph.pl and speedscope read) plus a summary of the busiest functions.
+#Switch it on and off without a restart with SIGUSR1, or from the metrics
+#endpoint:
+#
+#    curl http://127.0.0.1:9108/debug/profile?action=start
+#    curl http://127.0.0.1:9108/debug/profile?action=stop
+#
+#Python only runs signal handlers on the main thread, which in the GUI process
+#is Tk's, so the HTTP command is the dependable way in there.
+#
+#The watchdog is told when the service loop starts and finishes a pass, and
+#when the GUI is handed work and when check_queue has done it. If either is
+#still going after WATCHDOG_THRESHOLD it dumps every thread's stack to stdout
+#and WATCHDOG_LOG, which shows what it is blocked on. Because the GUI's clock
+#starts when work is posted, a Tk thread stuck anywhere else (a callback, a
+#dialog) is caught too. Stacks can also be dumped on demand with SIGUSR2 or
+#/debug/stacks. Per stage loop timings are in the metrics, see
+#patron_loop_stage_seconds.
+
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+PROFILE_INTERVAL = 0.01 #Seconds between stack samples
+PROFILE_SUMMARY_ROWS = 15 #Functions listed per thread in the summary
+
+WATCHDOG_THRESHOLD = 2.0 #Seconds a pass may take before stacks are dumped
+WATCHDOG_LOG = "stalls.log"
+
+def thread_names():
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+def format_stacks():
+    names = thread_names()
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append(f"Thread {names.get(ident, ident)}:")
+        lines.extend(line.rstrip("\n") for line in traceback.format_stack(frame))
+    return "\n".join(lines) + "\n"
+
+def dump_stacks(reason):
+    text = f"===== {time.strftime('%Y-%m-%d %H:%M:%S')} {reason} =====\n" + format_stacks()
+    print(text)
+    try:
+        with open(WATCHDOG_LOG, 'a') as file:
+            file.write(text + "\n")
+    except OSError as e:
+        print(f"Could not write {WATCHDOG_LOG}: {e}")
+    return text
+
+##################
+# STACK SAMPLER  #
+##################
+
+class StackSampler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter() #Folded stack -> samples
+        self.samples = 0
+        self.started = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running():
+            return
+        self.counts.clear()
+        self.samples = 0
+        self.started = time.time()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    # Stop sampling and write the profile. Returns the path written.
+    def stop(self):
+        if not self.running():
+            return None
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+        path = f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))}.folded"
+        with open(path, 'w') as file:
+            for stack, count in self.counts.most_common():
+                file.write(f"{stack} {count}\n")
+        return path
+
+    # Samples per thread and the functions most often at the top of its stack
+    def summary(self):
+        threads = collections.Counter()
+        leaves = collections.defaultdict(collections.Counter)
+        for stack, count in dict(self.counts).items(): #Copied, may be called while sampling
+            frames = stack.split(";")
+            threads[frames[0]] += count
+            leaves[frames[0]][frames[-1]] += count
+
+        elapsed = time.time() - self.started if self.started else 0
+        lines = [f"{self.samples} samples over {elapsed:.1f}s"]
+        for thread, total in threads.most_common():
+            lines.append(f"\nThread {thread}: {total} samples")
+            for function, count in leaves[thread].most_common(PROFILE_SUMMARY_ROWS):
+                lines.append(f"  {100 * count / total:5.1f}%  {function}")
+        return "\n".join(lines) + "\n"
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            names = thread_names()
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                functions = []
+                while frame is not None:
+                    code = frame.f_code
+                    functions.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                functions.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(functions))] += 1
+            self.samples += 1
+
+SAMPLER = StackSampler()
+
+def start_profiling():
+    SAMPLER.start()
+    print("Profiling started")
+
+def stop_profiling():
+    path = SAMPLER.stop()
+    if path is None:
+        return "Profiling is not running\n"
+    summary = SAMPLER.summary()
+    print(f"Profile written to {path}\n{summary}")
+    return f"Profile written to {path}\n{summary}"
+
+def toggle_profiling():
+    if SAMPLER.running():
+        stop_profiling()
+    else:
+        start_profiling()
+
+############
+# WATCHDOG #
+############
+
+class Watchdog:
+    def __init__(self, threshold=WATCHDOG_THRESHOLD):
+        self.threshold = threshold
+        self.busy = {} #name -> time.monotonic() the pass started or work was posted
+        self.stalled = set() #Names whose current pass was already reported
+        self._thread = None
+
+    # name started a pass. Cheap, called from the passes themselves.
+    def enter(self, name):
+        self.busy[name] = time.monotonic()
+
+    # Work was posted for name, the clock starts unless it is already running.
+    # Safe from any thread.
+    def pending(self, name):
+        self.busy.setdefault(name, time.monotonic())
+
+    def leave(self, name):
+        started = self.busy.pop(name, None)
+        if name in self.stalled:
+            self.stalled.discard(name)
+            print(f"Watchdog -- {name} recovered after {time.monotonic() - started:.1f}s")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="watchdog", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.threshold / 4)
+            now = time.monotonic()
+            for name, started in list(self.busy.items()):
+                if (now - started >= self.threshold) and (name not in self.stalled):
+                    self.stalled.add(name)
+                    dump_stacks(f"{name} has not finished its work in {now - started:.1f}s")
+
+WATCHDOG = Watchdog()
+
+#################
+# ADMIN ACCESS  #
+#################
+
+def _profile_route(query):
+    action = query.get("action", "status")
+    if action == "start":
+        start_profiling()
+        return "Profiling started\n"
+    if action == "stop":
+        return stop_profiling()
+    if SAMPLER.running():
+        return "Profiling is running\n" + SAMPLER.summary()
+    return "Profiling is not running\n"
+
+metrics.add_route("/debug/profile", _profile_route)
+metrics.add_route("/debug/stacks", lambda query: format_stacks())
+
+# SIGUSR1 toggles profiling, SIGUSR2 dumps every thread's stack. Must be
+# called from the main thread; does nothing where the signals don't exist.
+def install_signals():
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    signal.signal(signal.SIGUSR1, lambda signum, frame: toggle_profiling())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: dump_stacks("SIGUSR2"))
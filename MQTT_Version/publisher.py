@@ -0,0 +1,87 @@
+#Publisher - Patron Handler Service - non-blocking outbound MQTT messages
+#publish() hands the message to paho and returns a future right away. The
+#future resolves with the publish latency once paho has written the message
+#to the socket, or fails with PublishError. At most MAX_INFLIGHT messages are
+#handed to paho at once; the rest wait in a bounded outbound queue.
+
+import collections
+import time
+import paho.mqtt.client as mqtt
+
+from metrics import PUBLISH_SECONDS, PUBLISH_ERRORS
+
+DEBUG_PUBLISH = False
+
+MAX_INFLIGHT = 32 #Messages handed to paho but not yet written to the socket
+OUTBOUND_QUEUE_SIZE = 256 #Messages allowed to wait behind the in-flight ones
+
+class PublishError(Exception):
+    pass
+
+class Publisher:
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.inflight = {} #mid -> (future, time handed to paho)
+        self.pending = collections.deque()
+
+    # Queue a message. Returns a future with the publish latency in seconds.
+    def publish(self, topic, payload, qos=0):
+        future = self.loop.create_future()
+        future.add_done_callback(self._report)
+
+        if len(self.inflight) < MAX_INFLIGHT:
+            self._send(topic, payload, qos, future)
+        elif len(self.pending) < OUTBOUND_QUEUE_SIZE:
+            self.pending.append((topic, payload, qos, future))
+        else:
+            future.set_exception(PublishError(f"Outbound queue full, dropped message on {topic}"))
+        return future
+
+    # paho's on_publish: the message with this mid reached the socket
+    def published(self, mid):
+        entry = self.inflight.pop(mid, None)
+        if entry is not None:
+            future, sent_at = entry
+            if not future.done():
+                future.set_result(time.time() - sent_at)
+        self._drain()
+
+    # Fail everything outstanding, e.g. when the connection drops
+    def reset(self, reason):
+        for future, sent_at in self.inflight.values():
+            if not future.done():
+                future.set_exception(PublishError(reason))
+        self.inflight.clear()
+
+        while self.pending:
+            future = self.pending.popleft()[3]
+            if not future.done():
+                future.set_exception(PublishError(reason))
+
+    def depth(self):
+        return len(self.inflight) + len(self.pending)
+
+    def _send(self, topic, payload, qos, future):
+        info = self.client.publish(topic=topic, payload=payload, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            future.set_exception(PublishError(f"Message publish failed: {mqtt.error_string(info.rc)}"))
+            return
+        self.inflight[info.mid] = (future, time.time())
+
+    def _drain(self):
+        while self.pending and len(self.inflight) < MAX_INFLIGHT:
+            topic, payload, qos, future = self.pending.popleft()
+            if not future.done():
+                self._send(topic, payload, qos, future)
+
+    def _report(self, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            PUBLISH_ERRORS.inc()
+            print(future.exception())
+            return
+        PUBLISH_SECONDS.observe(future.result())
+        if DEBUG_PUBLISH:
+            print(f"Publisher -- published in {future.result() * 1000:.1f} ms")
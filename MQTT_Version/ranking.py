@@ -0,0 +1,91 @@
+#Receiver ranking - Patron Handler Service
+#Learns from finished pages which badges tend to accept, and how quickly, so
+#the paging state machine can try the most likely responders first. Stats are
+#updated incrementally as each page attempt ends.
+
+import bisect
+import collections
+
+DEBUG_RANKING = False
+
+RANKING_WINDOW = 20 #Recent response times kept per badge for the median
+RANKING_REFUSAL_COOLDOWN = 60 #Seconds a badge drops to the back after refusing
+
+class ReceiverStats:
+    __slots__ = ("accepts", "refusals", "timeouts", "latencies", "sorted_latencies", "last_refusal")
+
+    def __init__(self):
+        self.accepts = 0
+        self.refusals = 0
+        self.timeouts = 0
+        self.latencies = collections.deque() #Arrival order, to evict the oldest
+        self.sorted_latencies = [] #Same values kept sorted for the median
+        self.last_refusal = None
+
+    def add_latency(self, latency):
+        self.latencies.append(latency)
+        bisect.insort(self.sorted_latencies, latency)
+        if len(self.latencies) > RANKING_WINDOW:
+            oldest = self.latencies.popleft()
+            del self.sorted_latencies[bisect.bisect_left(self.sorted_latencies, oldest)]
+
+    def median_latency(self):
+        count = len(self.sorted_latencies)
+        if count == 0:
+            return None
+        middle = count // 2
+        if count % 2:
+            return self.sorted_latencies[middle]
+        return (self.sorted_latencies[middle - 1] + self.sorted_latencies[middle]) / 2
+
+class ReceiverRanker:
+    def __init__(self, response_window):
+        self.response_window = response_window #Seconds a badge gets to answer
+        self.stats = {} #client_id -> ReceiverStats
+
+    def _stats(self, client_id):
+        stats = self.stats.get(client_id)
+        if stats is None:
+            stats = self.stats[client_id] = ReceiverStats()
+        return stats
+
+    def record_accept(self, client_id, latency):
+        stats = self._stats(client_id)
+        stats.accepts += 1
+        stats.add_latency(latency)
+
+    def record_refusal(self, client_id, latency, now):
+        stats = self._stats(client_id)
+        stats.refusals += 1
+        stats.add_latency(latency)
+        stats.last_refusal = now
+
+    def record_timeout(self, client_id):
+        self._stats(client_id).timeouts += 1
+
+    # Higher is better. Unknown badges score as an even chance with an
+    # average response time.
+    def score(self, client_id, now):
+        stats = self.stats.get(client_id)
+        if stats is None:
+            return 0.5 * 0.75
+
+        outcomes = stats.accepts + stats.refusals + stats.timeouts
+        acceptRate = (stats.accepts + 1) / (outcomes + 2)
+
+        median = stats.median_latency()
+        speed = 0.5 if median is None else 1 - min(median / self.response_window, 1)
+        score = acceptRate * (0.5 + 0.5 * speed)
+
+        #Someone who just said no goes behind everyone else for a while
+        if stats.last_refusal is not None and (now - stats.last_refusal) < RANKING_REFUSAL_COOLDOWN:
+            score -= 1
+        return score
+
+    # Return records best score first. The sort is stable, so ties keep the
+    # order they were given in.
+    def order(self, records, now):
+        ranked = sorted(records, key=lambda record: -self.score(record.client_id, now))
+        if DEBUG_RANKING:
+            print("Ranking -- " + ", ".join(f"{r.client_id}={self.score(r.client_id, now):.2f}" for r in ranked))
+        return ranked
@@ -0,0 +1,75 @@
+#Staged registration - Patron Handler Service
+#Asking a whole fleet to register at once has every badge answer within a few
+#milliseconds. Instead badges are split into cohorts by a hash of their MAC and
+#each cohort is asked in its own wave, REGISTER_WAVE_INTERVAL apart. Badges add
+#up to REGISTER_JITTER_MS of random delay before answering (see tech_badge.ino).
+#
+#Register messages are queued as they arrive and applied in batches, at most
+#as fast as the token bucket allows. Nothing is dropped, a burst just waits its
+#turn, so the whole fleet is visible after about
+#REGISTER_WAVE_COHORTS * REGISTER_WAVE_INTERVAL seconds.
+#
+#Badges on firmware older than the waves and roll call ignore both commands
+#and only answer a plain COMMAND_REGISTER. While LEGACY_REGISTER_FALLBACK is
+#set one global COMMAND_REGISTER follows the last wave (or the roll call after
+#a warm start). Current firmware skips it when it registered or heard from the
+#server recently, so only older badges answer, through the same rate limited
+#intake. Turn it off once every badge has been reflashed.
+
+import collections
+
+DEBUG_REGISTRATION = False
+
+REGISTER_WAVE_COHORTS = 8 #Waves a full re-registration is split into
+REGISTER_WAVE_INTERVAL = .5 #Seconds between waves
+REGISTER_JITTER_MS = 400 #Badges answer a wave after a random delay up to this
+REGISTER_BATCH_INTERVAL = REGISTER_WAVE_INTERVAL #Seconds register messages collect before a batch is applied
+REGISTER_RATE = 200 #Register messages applied per second
+REGISTER_BURST = 100 #Most register messages applied in one batch
+LEGACY_REGISTER_FALLBACK = True #Ask older badges to register too, see above
+LEGACY_REGISTER_DELAY = 2 #Seconds after the last wave or roll call before the fallback
+
+# Cohort a badge answers in. FNV-1a over the MAC string, the badge firmware
+# computes the same hash.
+def cohort_of(client_id, cohorts):
+    h = 0x811c9dc5
+    for b in client_id.encode('utf-8'):
+        h = ((h ^ b) * 0x01000193) & 0xffffffff
+    return h % cohorts
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take up to count tokens, returns how many were granted
+    def take(self, count, now):
+        self._refill(now)
+        granted = min(count, int(self.tokens))
+        self.tokens -= granted
+        return granted
+
+class RegistrationIntake:
+    def __init__(self, now):
+        self.bucket = TokenBucket(REGISTER_RATE, REGISTER_BURST, now)
+        self.pending = collections.deque() #Raw register payloads in arrival order
+        self.batchTimer = None
+        self.waveTimer = None
+        self.nextCohort = 0 #Next wave to send, REGISTER_WAVE_COHORTS once done
+
+    def queue(self, payload):
+        self.pending.append(payload)
+
+    # Payloads the bucket allows through right now, oldest first
+    def take_batch(self, now):
+        granted = self.bucket.take(len(self.pending), now)
+        batch = [self.pending.popleft() for _ in range(granted)]
+        if DEBUG_REGISTRATION:
+            print(f"Registration -- applying {len(batch)}, {len(self.pending)} waiting")
+        return batch
@@ -0,0 +1,143 @@
+#Client registry - Patron Handler Service
+#One ClientRecord per registered badge, indexed by status. ACTIVE badges are
+#also linked into a ring so the next receiver to page is found in O(1).
+
+#Client status ENUMS
+CLIENT_STATUS_OFFLINE = 0
+CLIENT_STATUS_INACTIVE = 1
+CLIENT_STATUS_ACTIVE = 2
+
+#Client response ENUMS
+RESPONSE_NONE   = 0
+RESPONSE_ACCEPT = 1
+RESPONSE_DENY   = 2
+
+class ClientRecord:
+    __slots__ = ("client_id", "name", "last_ping", "status", "response", "ring_prev", "ring_next", "liveness_due")
+
+    def __init__(self, client_id, name, last_ping):
+        self.client_id = client_id
+        self.name = name
+        self.last_ping = last_ping
+        self.status = CLIENT_STATUS_INACTIVE
+        self.response = RESPONSE_NONE
+        self.ring_prev = None
+        self.ring_next = None
+        self.liveness_due = None #See liveness.py
+
+    def __repr__(self):
+        return f"ClientRecord({self.client_id!r}, {self.name!r}, status={self.status})"
+
+class ClientRegistry:
+    def __init__(self):
+        self.clients = {} #client_id -> ClientRecord
+        self.by_status = {
+            CLIENT_STATUS_OFFLINE: set(),
+            CLIENT_STATUS_INACTIVE: set(),
+            CLIENT_STATUS_ACTIVE: set(),
+        }
+        self._cursor = None #Next ACTIVE record in the paging rotation
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __contains__(self, client_id):
+        return client_id in self.clients
+
+    def __iter__(self):
+        return iter(self.clients.values())
+
+    def get(self, client_id):
+        return self.clients.get(client_id)
+
+    def count(self, status):
+        return len(self.by_status[status])
+
+    # Add a client, or refresh it if it registers again. Returns (record, is_new).
+    def register(self, client_id, name, now):
+        record = self.clients.get(client_id)
+        is_new = record is None
+        if is_new:
+            record = ClientRecord(client_id, name, now)
+            self.clients[client_id] = record
+            self.by_status[record.status].add(client_id)
+        else:
+            record.name = name
+            record.last_ping = now
+
+        #Registering is proof the badge is alive
+        self.set_status(record, CLIENT_STATUS_ACTIVE)
+        return record, is_new
+
+    # The client reported in
+    def touch(self, record, now):
+        record.last_ping = now
+        self.set_status(record, CLIENT_STATUS_ACTIVE)
+
+    def set_status(self, record, status):
+        if record.status == status:
+            return
+        self.by_status[record.status].discard(record.client_id)
+        if record.status == CLIENT_STATUS_ACTIVE:
+            self._unlink(record)
+
+        record.status = status
+        self.by_status[status].add(record.client_id)
+        if status == CLIENT_STATUS_ACTIVE:
+            self._link(record)
+
+    def remove(self, client_id):
+        record = self.clients.pop(client_id, None)
+        if record is None:
+            return None
+        self.by_status[record.status].discard(client_id)
+        if record.status == CLIENT_STATUS_ACTIVE:
+            self._unlink(record)
+        return record
+
+    # Next ACTIVE client in round-robin order, skipping records for which
+    # skip(record) is true. Returns None once every ACTIVE client was skipped.
+    def next_receiver(self, skip=None):
+        for _ in range(len(self.by_status[CLIENT_STATUS_ACTIVE])):
+            record = self._cursor
+            self._cursor = record.ring_next
+            if skip is None or not skip(record):
+                return record
+        return None
+
+    # ACTIVE clients in rotation order, starting with the next one to page
+    def rotation(self):
+        record = self._cursor
+        for _ in range(len(self.by_status[CLIENT_STATUS_ACTIVE])):
+            yield record
+            record = record.ring_next
+
+    # Move the rotation on to the client after record, used when a receiver
+    # was picked out of order
+    def rotate_past(self, record):
+        if record.ring_next is not None:
+            self._cursor = record.ring_next
+
+    # Insert the record just behind the cursor so it is tried last
+    def _link(self, record):
+        if self._cursor is None:
+            record.ring_prev = record
+            record.ring_next = record
+            self._cursor = record
+            return
+        tail = self._cursor.ring_prev
+        record.ring_prev = tail
+        record.ring_next = self._cursor
+        tail.ring_next = record
+        self._cursor.ring_prev = record
+
+    def _unlink(self, record):
+        if record.ring_next is record:
+            self._cursor = None
+        else:
+            record.ring_prev.ring_next = record.ring_next
+            record.ring_next.ring_prev = record.ring_prev
+            if self._cursor is record:
+                self._cursor = record.ring_next
+        record.ring_prev = None
+        record.ring_next = None
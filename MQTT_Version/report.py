@@ -0,0 +1,323 @@
+#Page reports - Patron Handler
+#Builds the staff meeting report from the page time series (see timeseries.py):
+#per badge response time percentiles, how long patrons waited for help and
+#which hours of the week pages come in. Runs as its own process, e.g. from
+#cron, so the live service never does this work. The service's column files
+#are memory-mapped and every figure is computed with whole-array NumPy
+#operations. Without NumPy the same figures are computed in plain Python.
+#
+#Writes REPORT_DIR/report.txt, report.json and heatmap.ppm (which Tk can show
+#without Pillow). The data is as of the service's last checkpoint, see
+#ANALYTICS_CHECKPOINT_INTERVAL.
+#
+#Usage: python report.py [--site NAME] [--days N] [--out DIR]
+#A site in WORKER_SITES shares its history with the rest of its worker group,
+#so its report covers the whole group.
+
+import argparse
+import array
+import bisect
+import functools
+import json
+import math
+import os
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from timeseries import read_meta, column_path, page_store_path, start_of_day
+from sites import WORKER_SITES, store_name
+from timeseries import OUTCOME_ACCEPT, OUTCOME_DENY, OUTCOME_TIMEOUT, OUTCOME_CANCEL, OUTCOME_NO_HELP
+
+REPORT_DIR = "reports"
+REPORT_DAYS = 28
+REPORT_QUANTILES = (0.5, 0.9, 0.95)
+WAIT_HISTOGRAM_EDGES = (0, 5, 10, 20, 30, 45, 60, 90, 120) #Seconds, the last bin is open ended
+HEATMAP_CELL = 20 #Pixels per hour in heatmap.ppm
+
+DAYS_OF_WEEK = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+# Columns of the last checkpoint: ({name: column}, {name: column}, meta), or
+# None if the service hasn't written one. Memory-mapped NumPy arrays when
+# NumPy is installed, arrays read into memory otherwise.
+def load_columns(store_path):
+    meta = read_meta(store_path)
+    if meta is None:
+        return None
+
+    tables = {}
+    for table in ("requests", "attempts"):
+        rows = meta["rows"][table]
+        columns = tables[table] = {}
+        for name, code in meta["typecodes"][table].items():
+            path = column_path(store_path, meta["generation"], table, name)
+            if np is not None:
+                #A zero length file can't be mapped
+                columns[name] = np.memmap(path, dtype=np.dtype(code), mode='r', shape=(rows,)) if rows else np.empty(0, np.dtype(code))
+            else:
+                columns[name] = array.array(code)
+                with open(path, 'rb') as file:
+                    columns[name].fromfile(file, rows)
+    return tables["requests"], tables["attempts"], meta
+
+#Seconds east of UTC for a UTC day. Taken at noon, so the hours around a DST
+#change are off by one.
+@functools.lru_cache(maxsize=None)
+def utc_offset(utcDay):
+    return time.localtime(utcDay * 86400 + 43200).tm_gmtoff
+
+# Everything in the report for requests and attempts started between since
+# and until, as plain lists and dicts
+def build_report(requests, attempts, meta, since, until):
+    if np is not None:
+        requestRange = np.searchsorted(requests["start"], [since, until])
+        attemptRange = np.searchsorted(attempts["start"], [since, until])
+    else:
+        requestRange = [bisect.bisect_left(requests["start"], edge) for edge in (since, until)]
+        attemptRange = [bisect.bisect_left(attempts["start"], edge) for edge in (since, until)]
+    requests = {name: column[requestRange[0]:requestRange[1]] for name, column in requests.items()}
+    attempts = {name: column[attemptRange[0]:attemptRange[1]] for name, column in attempts.items()}
+
+    if np is not None:
+        techs = tech_table_numpy(attempts, len(meta["techs"]))
+        waits, waitCounts = wait_histogram_numpy(requests)
+        demand, noHelp = demand_matrices_numpy(requests)
+    else:
+        techs = tech_table_python(attempts, len(meta["techs"]))
+        waits, waitCounts = wait_histogram_python(requests)
+        demand, noHelp = demand_matrices_python(requests)
+
+    for tech, row in enumerate(techs):
+        row["client_id"] = meta["techs"][tech]
+        row["name"] = meta["names"].get(row["client_id"], row["client_id"])
+    techs = sorted((row for row in techs if row["attempts"]), key=lambda row: -row["accepts"])
+
+    return {
+        "generated": time.time(),
+        "since": since,
+        "until": until,
+        "through": meta["through"],
+        "requests": len(requests["start"]),
+        "accepted": sum(waitCounts),
+        "no_help": sum(map(sum, noHelp)),
+        "wait_quantiles": dict(zip(map(str, REPORT_QUANTILES), waits)),
+        "wait_histogram": {"edges": list(WAIT_HISTOGRAM_EDGES), "counts": waitCounts},
+        "techs": techs,
+        "demand": demand,
+        "no_help_demand": noHelp,
+    }
+
+#########
+# NUMPY #
+#########
+
+def tech_table_numpy(attempts, techCount):
+    tech = np.asarray(attempts["tech"], dtype=np.intp)
+    outcome = np.asarray(attempts["outcome"])
+    latency = np.asarray(attempts["latency"])
+
+    counts = {
+        "attempts": np.bincount(tech, minlength=techCount),
+        "accepts": np.bincount(tech[outcome == OUTCOME_ACCEPT], minlength=techCount),
+        "denies": np.bincount(tech[outcome == OUTCOME_DENY], minlength=techCount),
+        "timeouts": np.bincount(tech[outcome == OUTCOME_TIMEOUT], minlength=techCount),
+        "cancels": np.bincount(tech[outcome == OUTCOME_CANCEL], minlength=techCount),
+    }
+
+    #Accepted latencies grouped by badge, fastest first within each group
+    accepted = outcome == OUTCOME_ACCEPT
+    acceptedTech = tech[accepted]
+    acceptedLatency = latency[accepted]
+    order = np.lexsort((acceptedLatency, acceptedTech))
+    acceptedTech = acceptedTech[order]
+    acceptedLatency = acceptedLatency[order]
+    groupStart = np.searchsorted(acceptedTech, np.arange(techCount))
+    accepts = counts["accepts"]
+
+    quantiles = {}
+    for q in REPORT_QUANTILES:
+        #Nearest rank, like Rollup.percentile
+        rank = np.maximum(np.ceil(q * accepts).astype(np.intp) - 1, 0)
+        index = np.minimum(groupStart + rank, max(len(acceptedLatency) - 1, 0))
+        values = acceptedLatency[index] if len(acceptedLatency) else np.zeros(techCount)
+        quantiles[q] = np.where(accepts > 0, values, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(acceptedTech, weights=acceptedLatency, minlength=techCount) / accepts
+
+    rows = []
+    for tech in range(techCount):
+        row = {name: int(column[tech]) for name, column in counts.items()}
+        row["mean"] = none_if_nan(mean[tech])
+        row["quantiles"] = {str(q): none_if_nan(quantiles[q][tech]) for q in REPORT_QUANTILES}
+        rows.append(row)
+    return rows
+
+def wait_histogram_numpy(requests):
+    outcome = np.asarray(requests["outcome"])
+    wait = np.sort(np.asarray(requests["wait"])[outcome == OUTCOME_ACCEPT])
+    quantiles = [float(wait[max(math.ceil(q * len(wait)) - 1, 0)]) if len(wait) else None for q in REPORT_QUANTILES]
+    bins = np.searchsorted(WAIT_HISTOGRAM_EDGES, wait, side='right') - 1
+    counts = np.bincount(np.maximum(bins, 0), minlength=len(WAIT_HISTOGRAM_EDGES))
+    return quantiles, counts.tolist()
+
+def demand_matrices_numpy(requests):
+    start = np.asarray(requests["start"])
+    utcDays, inverse = np.unique((start // 86400).astype(np.int64), return_inverse=True)
+    offsets = np.array([utc_offset(int(day)) for day in utcDays], dtype=np.float64)
+    local = start + offsets[inverse.reshape(-1)] if len(start) else start
+    weekday = ((local // 86400).astype(np.int64) + 3) % 7 #1970-01-01 was a Thursday
+    hour = ((local % 86400) // 3600).astype(np.int64)
+    cell = weekday * 24 + hour
+
+    noHelp = np.asarray(requests["outcome"]) == OUTCOME_NO_HELP
+    demand = np.bincount(cell, minlength=7 * 24).reshape(7, 24)
+    noHelpDemand = np.bincount(cell[noHelp], minlength=7 * 24).reshape(7, 24)
+    return demand.tolist(), noHelpDemand.tolist()
+
+def none_if_nan(value):
+    value = float(value)
+    return None if math.isnan(value) else value
+
+###############
+# PURE PYTHON #
+###############
+
+def tech_table_python(attempts, techCount):
+    rows = [{"attempts": 0, "accepts": 0, "denies": 0, "timeouts": 0, "cancels": 0} for _ in range(techCount)]
+    latencies = [[] for _ in range(techCount)]
+    for tech, outcome, latency in zip(attempts["tech"], attempts["outcome"], attempts["latency"]):
+        row = rows[tech]
+        row["attempts"] += 1
+        if outcome == OUTCOME_ACCEPT:
+            row["accepts"] += 1
+            latencies[tech].append(latency)
+        elif outcome == OUTCOME_DENY:
+            row["denies"] += 1
+        elif outcome == OUTCOME_TIMEOUT:
+            row["timeouts"] += 1
+        elif outcome == OUTCOME_CANCEL:
+            row["cancels"] += 1
+
+    for row, values in zip(rows, latencies):
+        values.sort()
+        row["mean"] = (sum(values) / len(values)) if values else None
+        row["quantiles"] = {str(q): nearest_rank(values, q) for q in REPORT_QUANTILES}
+    return rows
+
+def wait_histogram_python(requests):
+    wait = sorted(wait for wait, outcome in zip(requests["wait"], requests["outcome"]) if outcome == OUTCOME_ACCEPT)
+    counts = [0] * len(WAIT_HISTOGRAM_EDGES)
+    for value in wait:
+        counts[max(bisect.bisect_right(WAIT_HISTOGRAM_EDGES, value) - 1, 0)] += 1
+    return [nearest_rank(wait, q) for q in REPORT_QUANTILES], counts
+
+def demand_matrices_python(requests):
+    demand = [[0] * 24 for _ in range(7)]
+    noHelp = [[0] * 24 for _ in range(7)]
+    for start, outcome in zip(requests["start"], requests["outcome"]):
+        local = start + utc_offset(int(start // 86400))
+        weekday = (int(local // 86400) + 3) % 7
+        hour = int((local % 86400) // 3600)
+        demand[weekday][hour] += 1
+        if outcome == OUTCOME_NO_HELP:
+            noHelp[weekday][hour] += 1
+    return demand, noHelp
+
+def nearest_rank(values, q):
+    if not values:
+        return None
+    return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+##########
+# OUTPUT #
+##########
+
+def format_report(report):
+    def seconds(value):
+        return "-" if value is None else f"{value:.1f}s"
+
+    since = time.strftime("%b %d %Y", time.localtime(report["since"]))
+    until = time.strftime("%b %d %Y", time.localtime(report["until"]))
+    generated = time.strftime("%b %d %Y %H:%M", time.localtime(report["generated"]))
+    lines = [
+        f"Patron Handler report, {since} - {until}",
+        f"Generated {generated}",
+        "",
+        f"Page requests: {report['requests']}   Helped: {report['accepted']}   No help: {report['no_help']}",
+        "Wait for help: " + "   ".join(f"p{round(float(q) * 100)} {seconds(value)}" for q, value in report["wait_quantiles"].items()),
+        "",
+        f"{'Staff':<16}{'Pages':>7}{'Accept':>8}{'Deny':>6}{'Missed':>8}{'Beaten':>8}{'Mean':>8}" + "".join(f"{'p' + str(round(q * 100)):>8}" for q in REPORT_QUANTILES),
+    ]
+    for row in report["techs"]:
+        lines.append(f"{row['name'][:15]:<16}{row['attempts']:>7}{row['accepts']:>8}{row['denies']:>6}{row['timeouts']:>8}{row['cancels']:>8}{seconds(row['mean']):>8}"
+                     + "".join(f"{seconds(value):>8}" for value in row["quantiles"].values()))
+
+    lines += ["", "Time to help"]
+    edges = report["wait_histogram"]["edges"]
+    counts = report["wait_histogram"]["counts"]
+    widest = max(counts) if counts and max(counts) else 1
+    for index, count in enumerate(counts):
+        label = f"{edges[index]}-{edges[index + 1]}s" if index + 1 < len(edges) else f"{edges[index]}s+"
+        lines.append(f"{label:>10} {count:>6} {'#' * round(30 * count / widest)}")
+
+    lines += ["", "Busiest hours"]
+    busiest = sorted(((count, day, hour) for day, hours in enumerate(report["demand"]) for hour, count in enumerate(hours) if count),
+                     reverse=True)[:5]
+    for count, day, hour in busiest:
+        lines.append(f"{DAYS_OF_WEEK[day]} {hour:02d}:00  {count} requests, {report['no_help_demand'][day][hour]} with no help")
+    return "\n".join(lines) + "\n"
+
+#Binary PPM, one row per weekday from Monday, one column per hour, white for
+#no requests through to red for the busiest hour
+def heatmap_ppm(demand, cell=HEATMAP_CELL):
+    busiest = max(max(hours) for hours in demand) or 1
+    rows = []
+    for hours in demand:
+        pixels = bytearray()
+        for count in hours:
+            shade = round(255 * (1 - count / busiest))
+            pixels += bytes((255, shade, shade)) * cell
+        rows.append(bytes(pixels) * cell)
+    return f"P6 {24 * cell} {7 * cell} 255\n".encode() + b"".join(rows)
+
+def write_file(path, data):
+    with open(path + ".tmp", 'wb') as file:
+        file.write(data)
+    os.replace(path + ".tmp", path)
+
+def write_report(report, out_dir=REPORT_DIR):
+    os.makedirs(out_dir, exist_ok=True)
+    write_file(os.path.join(out_dir, "report.json"), json.dumps(report).encode())
+    write_file(os.path.join(out_dir, "report.txt"), format_report(report).encode())
+    write_file(os.path.join(out_dir, "heatmap.ppm"), heatmap_ppm(report["demand"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the page report for staff meetings")
+    parser.add_argument("--site", default="", help="site the service pages for, blank for the GUI's own sites")
+    parser.add_argument("--days", type=int, default=REPORT_DAYS, help="days covered, up to today")
+    parser.add_argument("--out", default=REPORT_DIR, help="directory the report files go in")
+    args = parser.parse_args()
+
+    name = store_name(args.site)
+    loaded = load_columns(page_store_path(name))
+    if loaded is None:
+        print("No page history yet, the service writes it every few minutes")
+        return
+    requests, attempts, meta = loaded
+
+    until = time.time()
+    since = start_of_day(until) - (args.days - 1) * 86400
+    started = time.perf_counter()
+    report = build_report(requests, attempts, meta, since, until)
+    write_report(report, args.out)
+    for group in WORKER_SITES:
+        if args.site in group and len(group) > 1:
+            print(f"{args.site!r} is served with {', '.join(repr(site) for site in group if site != args.site)}, the report covers them all")
+    print(f"Report of {report['requests']} requests written to {args.out} in {time.perf_counter() - started:.2f}s"
+          f" ({'numpy' if np is not None else 'pure python'})")
+
+if __name__ == "__main__":
+    main()
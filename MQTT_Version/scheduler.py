@@ -0,0 +1,101 @@
+#Scheduler - Patron Handler Service - deadline driven timers
+#Replaces the fixed sleep-poll in main.loop(). Every timed event (health pings,
+#client status timeouts, page timeouts) is pushed on a heap by its deadline and
+#the service loop sleeps until the earliest one is due or until it is woken.
+#
+#The scheduler lives on the service's asyncio event loop. call_at, call_later
+#and run_due must be called from that loop; wake() is safe from any thread.
+
+import asyncio
+import heapq
+import itertools
+import time
+
+from metrics import LOOP_LAG_SECONDS
+
+DEBUG_SCHEDULER = False
+
+# Handle returned by call_at/call_later so a pending timer can be cancelled
+class Timer:
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler:
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._loop = None
+        self._event = None
+        self._woken = False
+
+    # Bind the scheduler to the running event loop
+    def attach(self, loop):
+        self._loop = loop
+        self._event = asyncio.Event()
+        if self._woken:
+            self._event.set()
+
+    # Run callback at an absolute time.time() deadline
+    def call_at(self, deadline, callback):
+        timer = Timer(deadline, callback)
+        heapq.heappush(self._heap, (deadline, next(self._counter), timer))
+        # Only interrupt the sleeper if this timer is now the earliest one
+        if self._heap[0][2] is timer and self._event is not None:
+            self._event.set()
+        return timer
+
+    # Run callback after delay seconds
+    def call_later(self, delay, callback):
+        return self.call_at(time.time() + delay, callback)
+
+    # Wake the service loop immediately (new message, GUI request...)
+    def wake(self):
+        self._woken = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    # Deadline of the earliest pending timer, or None if nothing is scheduled
+    def next_deadline(self):
+        self._discard_cancelled()
+        return self._heap[0][0] if self._heap else None
+
+    # Sleep until the earliest timer is due or wake() is called
+    async def wait(self, timeout=None):
+        deadline = self.next_deadline()
+        if deadline is not None:
+            due = deadline - time.time()
+            timeout = due if timeout is None else min(timeout, due)
+
+        if timeout is None or timeout > 0:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._event.clear()
+        self._woken = False
+
+    # Run all timers whose deadline has passed. Returns the number executed.
+    def run_due(self):
+        ran = 0
+        while True:
+            self._discard_cancelled()
+            if not self._heap or self._heap[0][0] > time.time():
+                return ran
+            timer = heapq.heappop(self._heap)[2]
+            LOOP_LAG_SECONDS.observe(max(time.time() - timer.deadline, 0))
+
+            if DEBUG_SCHEDULER:
+                print(f"Scheduler -- running {timer.callback}")
+            timer.callback()
+            ran += 1
+
+    def _discard_cancelled(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
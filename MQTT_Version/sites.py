@@ -0,0 +1,99 @@
+#Sites - Patron Handler Service
+#One service process can look after several locations. Every site has its own
+#topic prefix, registry, health tracking and paging engine, so the badges and
+#page requests of one site never see another's. The default site '' keeps the
+#original topics (server/register, client/global, <client_id>) so existing
+#badges work unchanged; any other site uses site/<name>/... topics.
+
+import queue
+import time
+
+from registry import ClientRegistry
+from liveness import LivenessIndex
+from ranking import ReceiverRanker
+from paging import WAIT_TIME_MS, MILLIS_TO_SEC
+from journal import RegistryJournal, journal_path
+from registration import RegistrationIntake
+
+#Sites served by the GUI process, the first one takes the GUI's page requests
+LOCAL_SITES = ['']
+
+#Groups of sites that each run headless in a worker process of their own, e.g.
+#[['library', 'lab2'], ['helpdesk']]. Move sites here when one host saturates.
+WORKER_SITES = []
+
+SITE_TOPIC_ROOT = 'site'
+
+def site_prefix(name):
+    return f"{SITE_TOPIC_ROOT}/{name}/" if name else ""
+
+# Name of the site a topic belongs to
+def site_name(topic):
+    if topic.startswith(SITE_TOPIC_ROOT + '/'):
+        return topic.split('/', 2)[1]
+    return ''
+
+# Name a process serving site_names gives its analytics, page store and trace
+# files, e.g. 'library-lab2'. The GUI process's files have no name.
+def group_name(site_names):
+    return "-".join(site_names)
+
+# Name of the files holding site's history: its worker group's, or '' for a
+# site served by the GUI process
+def store_name(site):
+    for group in WORKER_SITES:
+        if site in group:
+            return group_name(group)
+    return ''
+
+class Site:
+    def __init__(self, name):
+        if any(c in name for c in '/+#'):
+            raise ValueError(f"Site name {name!r} can't be used in an MQTT topic")
+        self.name = name
+        self.prefix = site_prefix(name)
+
+        self.registry = ClientRegistry()
+        self.liveness = LivenessIndex() #When each client next needs the health sweep
+        self.ranker = ReceiverRanker(WAIT_TIME_MS / MILLIS_TO_SEC)
+        self.health_prober = None #Set up once the MQTT client exists
+        self.paging = None
+        self.healthSweepTimer = None
+        self.journal = RegistryJournal(journal_path(name)) #Known badges on disk
+        self.journalTimer = None
+        self.registration = RegistrationIntake(time.time()) #Register messages waiting to be applied
+
+    def __repr__(self):
+        return f"Site({self.name!r})"
+
+    def topic(self, suffix):
+        return self.prefix + suffix
+
+# Stand-in for the GUI in worker processes. Display updates are dropped and
+# no page requests come in from a screen, kiosks send theirs over MQTT on the
+# site's server/request topic (see handleRequest in main.py).
+class HeadlessGUI:
+    class _Discard:
+        def put(self, task, priority=None):
+            pass
+
+        def __len__(self):
+            return 0
+
+        def stats(self):
+            return {}
+
+    class _DiscardView:
+        def update(self, record, status):
+            pass
+
+        def remove(self, client_id):
+            pass
+
+        def pending(self):
+            return 0
+
+    def __init__(self):
+        self.queue = HeadlessGUI._Discard()
+        self.view = HeadlessGUI._DiscardView()
+        self.server_message_queue = queue.Queue()
@@ -36,6 +36,22 @@ the client.
 #define COMMAND_HEALTH    1
 #define COMMAND_PAGE      2
 #define COMMAND_CANCEL    3
+#define COMMAND_ROLL_CALL 4 //Register unless the server was in touch recently
+#define COMMAND_REGISTER_WAVE 5 //"5 <cohort> <cohorts>", register if we are in that cohort
+
+//Longest random delay before answering a registration wave
+#define REGISTER_JITTER_MS 400
+
+//Send messages in the compact binary format instead of JSON (see the
+//service's codec.py). The server understands both.
+//#define WIRE_BINARY
+#define BINARY_MAGIC_V1 0xB1
+#define MSG_REGISTER 0
+#define MSG_HEALTH   1
+#define MSG_PAGER    2
+
+//A badge the server probed within this window is already known to it
+#define ROLL_CALL_WINDOW_MS 30000
 
 //Client response ENUMS
 #define RESPONSE_NONE   0
@@ -48,10 +64,24 @@ the client.
 //Flags for different commands
 bool pingHealth;
 bool clientRegistered;
+bool heardFromServer = false;
+unsigned long lastServerContact = 0;
+bool sentRegister = false;
+unsigned long lastRegisterSent = 0;
+bool registerPending = false;
+unsigned long registerAt = 0;
 volatile bool paging = false;
 
 //MQTT connection variables/constants
 const char* mqtt_server = "10.2.117.37";
+//Topic prefix of the site this badge belongs to, e.g. "site/library/".
+//Leave empty for the default site.
+#define SITE_PREFIX ""
+
+//Full topic name for this badge's site
+String siteTopic(String suffix) {
+  return String(SITE_PREFIX) + suffix;
+}
  
 #include <WiFi.h> //Wifi library
 #include "esp_wpa2.h" //wpa2 library for connections to Enterprise networks
@@ -172,8 +202,8 @@ void connect_mqttServer() {
       Serial.println("connected");
       display_message("Connected");
       // Subscribe to topics here
-      client.subscribe(clientID);
-      client.subscribe("client/global");
+      client.subscribe(siteTopic(clientID).c_str());
+      client.subscribe(siteTopic("client/global").c_str());
       digitalWrite(conn_pin, HIGH);
       
     } 
@@ -218,17 +248,54 @@ void callback(char* topic, byte* message, unsigned int length) {
   #endif
 
   // Check if a message is received on the topic unique to the client (its MAC address)
-  if ((String(topic) == badgeMACAddress) || (String(topic) == "client/global")) {
+  //Messages on our own topic mean the server knows who we are, unless it is
+  //asking us to register
+  if ((String(topic) == siteTopic(badgeMACAddress)) && (messageTemp.toInt() != COMMAND_REGISTER)) {
+    heardFromServer = true;
+    lastServerContact = millis();
+  }
+
+  if ((String(topic) == siteTopic(badgeMACAddress)) || (String(topic) == siteTopic("client/global"))) {
     switch (messageTemp.toInt())
     {
       //In cases when the service restarts when multiple clients 
-      //are already online, we ask them to re-register
+      //are already online, we ask them to re-register.
+      //A global register is now only the server's fallback for badges on
+      //older firmware, skip it if we registered or heard from it recently.
       case COMMAND_REGISTER:
+        if ((String(topic) == siteTopic("client/global")) &&
+            ((sentRegister && (millis() - lastRegisterSent <= ROLL_CALL_WINDOW_MS)) ||
+             (heardFromServer && (millis() - lastServerContact <= ROLL_CALL_WINDOW_MS)))) {
+          break;
+        }
         #ifdef DEBUG_CALLBACK
         Serial.println("Register request made by server");
         #endif
         RegisterClient();
         break;
+      //After a restart the server only wants badges it didn't remember
+      case COMMAND_ROLL_CALL:
+        if (!heardFromServer || (millis() - lastServerContact > ROLL_CALL_WINDOW_MS)) {
+          #ifdef DEBUG_CALLBACK
+          Serial.println("Roll call, registering");
+          #endif
+          RegisterClient();
+        }
+        break;
+      //Staged re-registration, only our cohort answers and after a random
+      //delay so the server isn't flooded
+      case COMMAND_REGISTER_WAVE: {
+        int command, cohort, cohorts;
+        if ((sscanf(messageTemp.c_str(), "%d %d %d", &command, &cohort, &cohorts) == 3) && (cohorts > 0) &&
+            (registerCohort(cohorts) == cohort)) {
+          #ifdef DEBUG_CALLBACK
+          Serial.println("Registration wave for our cohort");
+          #endif
+          registerPending = true;
+          registerAt = millis() + random(REGISTER_JITTER_MS);
+        }
+        break;
+      }
       case COMMAND_HEALTH:
         #ifdef DEBUG_CALLBACK
         Serial.println("Health request made by server");
@@ -266,6 +333,45 @@ void callback(char* topic, byte* message, unsigned int length) {
   //Similarly add more if statements to check for other subscribed topics 
 }
 
+/* registerCohort()
+Cohort this badge answers registration waves in. FNV-1a over the MAC
+string, must match cohort_of() in the service's registration.py
+*/
+int registerCohort(int cohorts) {
+  uint32_t h = 0x811c9dc5;
+  for (unsigned int i = 0; i < badgeMACAddress.length(); i++) {
+    h = (h ^ (uint8_t)badgeMACAddress[i]) * 0x01000193;
+  }
+  return h % cohorts;
+}
+
+#ifdef WIRE_BINARY
+/* binaryHeader()
+Writes the header of a binary message (magic|version, message type and
+the 6 byte MAC) to buf and returns its length
+*/
+int binaryHeader(uint8_t* buf, uint8_t type) {
+  unsigned int mac[6];
+  sscanf(badgeMACAddress.c_str(), "%x:%x:%x:%x:%x:%x", &mac[0], &mac[1], &mac[2], &mac[3], &mac[4], &mac[5]);
+  buf[0] = BINARY_MAGIC_V1;
+  buf[1] = type;
+  for (int i = 0; i < 6; i++) {
+    buf[2 + i] = (uint8_t)mac[i];
+  }
+  return 8;
+}
+
+/* publishBinary()
+Publishes a binary message carrying a single value (health, pager)
+*/
+void publishBinary(const char* suffix, uint8_t type, uint8_t value) {
+  uint8_t buf[9];
+  int length = binaryHeader(buf, type);
+  buf[length++] = value;
+  client.publish(siteTopic(suffix).c_str(), buf, length);
+}
+#endif
+
 /* RegisterClient()
 client contacts the server (raspberrypi) with a data packet of client
 characteristics.
@@ -275,6 +381,21 @@ clientID - unique address of the client. Used for topic creation so
 we can communicate with specific clients
 */
 void RegisterClient(){
+  sentRegister = true;
+  lastRegisterSent = millis();
+
+  #ifdef WIRE_BINARY
+  uint8_t buf[64];
+  int length = binaryHeader(buf, MSG_REGISTER);
+  uint8_t nameLength = min((int)strlen(CLIENT_NAME), (int)sizeof(buf) - length - 3);
+  buf[length++] = 1; //Showing that it is not active
+  buf[length++] = RESPONSE_NONE;
+  buf[length++] = nameLength;
+  memcpy(buf + length, CLIENT_NAME, nameLength);
+  client.publish(siteTopic("server/register").c_str(), buf, length + nameLength);
+  return;
+  #endif
+
   StaticJsonDocument<80> doc;
   char output[80];
 
@@ -292,7 +413,7 @@ void RegisterClient(){
   serializeJson(doc, output);
     
   // Publishing to the server/register topic
-  client.publish("server/register", output); //topic name (to which this ESP32 publishes its data). 88 is the dummy value.
+  client.publish(siteTopic("server/register").c_str(), output); //topic name (to which this ESP32 publishes its data). 88 is the dummy value.
 }
 
 /* HealthPing()
@@ -301,6 +422,12 @@ to say that it is still active.
 */
 void HealthPing(){
   Serial.println("In HealthPing");
+  #ifdef WIRE_BINARY
+  publishBinary("server/health", MSG_HEALTH, 1);
+  pingHealth = false;
+  return;
+  #endif
+
   StaticJsonDocument<80> doc;
   char output[80];
 
@@ -313,7 +440,7 @@ void HealthPing(){
   serializeJson(doc, output);
     
   // Publishing to the server/health topic
-  client.publish("server/health", output); //topic name (to which this ESP32 publishes its data). 88 is the dummy value.
+  client.publish(siteTopic("server/health").c_str(), output); //topic name (to which this ESP32 publishes its data). 88 is the dummy value.
 
   pingHealth = false;
 }
@@ -390,6 +517,11 @@ void loop() {
     }
   }
 
+  if (registerPending && ((long)(millis() - registerAt) >= 0)){
+    registerPending = false;
+    RegisterClient();
+  }
+
   if (pingHealth){
     HealthPing();
   }
@@ -402,6 +534,10 @@ void loop() {
       Serial.println("Accept");
       display_message("Accept");
 
+      #ifdef WIRE_BINARY
+      publishBinary("server/pager", MSG_PAGER, RESPONSE_ACCEPT);
+      #else
+
       StaticJsonDocument<80> doc;
       char output[80];
 
@@ -414,7 +550,8 @@ void loop() {
       serializeJson(doc, output);
         
       // Publishing to the sensor 1 topic
-      client.publish("server/pager", output); //topic name (to which this ESP32 publishes its data)
+      client.publish(siteTopic("server/pager").c_str(), output); //topic name (to which this ESP32 publishes its data)
+      #endif
       setPaging(false);
     }
   
@@ -422,6 +559,11 @@ void loop() {
     {
       Serial.println("Refuse");
       display_message("Refuse");
+
+      #ifdef WIRE_BINARY
+      publishBinary("server/pager", MSG_PAGER, RESPONSE_DENY);
+      #else
+
       StaticJsonDocument<80> doc;
       char output[80];
 
@@ -434,7 +576,8 @@ void loop() {
       serializeJson(doc, output);
         
       // Publishing to the sensor 1 topic
-      client.publish("server/pager", output); //topic name (to which this ESP32 publishes its data)
+      client.publish(siteTopic("server/pager").c_str(), output); //topic name (to which this ESP32 publishes its data)
+      #endif
 
       setPaging(false);
     }
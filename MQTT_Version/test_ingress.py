@@ -0,0 +1,38 @@
+#Malformed badge and kiosk messages are logged and dropped by drainIngress,
+#they must never reach the handlers or stop the service loop.
+#Run with: python -m pytest test_ingress.py
+
+import types
+
+import pytest
+
+import codec
+import main
+from codec import MSG_HEALTH, MSG_PAGER, MSG_REQUEST
+
+NOT_OBJECTS = [b'[1]', b'5', b'"k"', b'null']
+
+class UntouchedSite:
+    def __init__(self):
+        self.registry = types.SimpleNamespace(get=self.fail)
+        self.paging = types.SimpleNamespace(request=self.fail, on_response=self.fail)
+
+    def fail(self, *args):
+        pytest.fail(f"Malformed message reached a handler with {args}")
+
+@pytest.mark.parametrize("payload", NOT_OBJECTS)
+def test_decode_rejects_json_that_is_not_an_object(payload):
+    with pytest.raises(codec.CodecError):
+        codec.decode(payload)
+
+@pytest.mark.parametrize("kind, topic", [
+    (MSG_HEALTH, "server/health"),
+    (MSG_PAGER, "server/pager"),
+    (MSG_REQUEST, "server/request"),
+])
+@pytest.mark.parametrize("payload", NOT_OBJECTS + [b'{}', b'{"i"', b'\xff'])
+def test_drain_ingress_drops_malformed_messages(monkeypatch, kind, topic, payload):
+    monkeypatch.setattr(main, "sites", {"": UntouchedSite()})
+    main.ingress.put(kind, topic, payload)
+    main.drainIngress()
+    assert not main.ingress
@@ -0,0 +1,494 @@
+#Page time series - Patron Handler Service
+#Keeps every page request and every attempt at a badge (who was tried, when,
+#how it ended and how long they took) fed from the analytics events, see
+#analytics.py. Records are stored column by column in typed arrays, and hourly
+#and daily rollups per badge are updated as each event comes in, so a question
+#like "p95 time to accept per tech this week" merges a handful of rollups
+#instead of rescanning history. Only the partial hours at the ends of a range
+#are counted from the raw attempts.
+#
+#Response times go into log spaced histogram buckets (RESPONSE_BUCKET_GROWTH
+#apart), which is what lets percentiles be merged across rollups. Raw records
+#are kept for PAGE_STORE_RAW_DAYS, hourly rollups for PAGE_STORE_HOURLY_DAYS
+#and daily rollups for good. The analytics log has the store written out
+#periodically and before it compacts, the events after that are replayed from
+#the log on start.
+
+import array
+import bisect
+import datetime
+import json
+import math
+import os
+import threading
+import time
+
+from analytics import EVENT_REQUEST, EVENT_ATTEMPT, EVENT_ACCEPT, EVENT_DENY, EVENT_TIMEOUT, EVENT_CANCEL, EVENT_NO_HELP
+
+DEBUG_TIMESERIES = False
+
+PAGE_STORE_RAW_DAYS = 400 #Days of raw records kept
+PAGE_STORE_HOURLY_DAYS = 35 #Days of hourly rollups kept
+PAGE_STORE_META = "meta.json"
+PAGE_STORE_OPEN_LIMIT = 3600 #Seconds before a request that never finished is given up on
+
+RESPONSE_BUCKET_BASE = 0.01 #Seconds, responses faster than this share the first bucket
+RESPONSE_BUCKET_GROWTH = 1.05 #Each bucket is 5% wider than the last
+
+#Outcomes, as stored in the outcome columns
+OUTCOME_PENDING = -1
+OUTCOME_ACCEPT = 0
+OUTCOME_DENY = 1
+OUTCOME_TIMEOUT = 2
+OUTCOME_NO_HELP = 3
+OUTCOME_CANCEL = 4 #Attempt stopped because another badge accepted
+
+#The store is a directory of column files and meta.json describing them
+def page_store_path(name):
+    return f"pages-{name}" if name else "pages"
+
+def read_meta(path):
+    try:
+        with open(os.path.join(path, PAGE_STORE_META), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def column_path(path, generation, table, name):
+    return os.path.join(path, f"{generation}-{table}-{name}.bin")
+
+def response_bucket(seconds):
+    if seconds <= RESPONSE_BUCKET_BASE:
+        return 0
+    return int(math.log(seconds / RESPONSE_BUCKET_BASE) / math.log(RESPONSE_BUCKET_GROWTH))
+
+#Middle of a bucket, what a percentile falling in it reports
+def bucket_value(bucket):
+    return RESPONSE_BUCKET_BASE * RESPONSE_BUCKET_GROWTH ** (bucket + 0.5)
+
+def start_of_day(now=None):
+    day = datetime.date.fromtimestamp(time.time() if now is None else now)
+    return time.mktime(day.timetuple())
+
+#Local midnight at the start of Monday
+def start_of_week(now=None):
+    day = datetime.date.fromtimestamp(time.time() if now is None else now)
+    day -= datetime.timedelta(days=day.weekday())
+    return time.mktime(day.timetuple())
+
+class Rollup:
+    __slots__ = ("attempts", "accepts", "denies", "timeouts", "cancels", "latency_sum", "histogram")
+
+    def __init__(self):
+        self.attempts = 0
+        self.accepts = 0
+        self.denies = 0
+        self.timeouts = 0
+        self.cancels = 0
+        self.latency_sum = 0.0 #Of accepted pages
+        self.histogram = {} #response_bucket -> accepted pages
+
+    def add_accept(self, latency):
+        self.accepts += 1
+        self.latency_sum += latency
+        bucket = response_bucket(latency)
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.attempts += other.attempts
+        self.accepts += other.accepts
+        self.denies += other.denies
+        self.timeouts += other.timeouts
+        self.cancels += other.cancels
+        self.latency_sum += other.latency_sum
+        for bucket, count in other.histogram.items():
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+
+    def mean_latency(self):
+        return (self.latency_sum / self.accepts) if self.accepts else None
+
+    # Time to accept at quantile q (0-1), None without any accepts
+    def percentile(self, q):
+        if not self.accepts:
+            return None
+        rank = max(1, math.ceil(q * self.accepts))
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                return bucket_value(bucket)
+
+    def to_list(self):
+        return [self.attempts, self.accepts, self.denies, self.timeouts, self.latency_sum,
+                [[bucket, count] for bucket, count in self.histogram.items()], self.cancels]
+
+    #Checkpoints from before cancels were counted have six values
+    @classmethod
+    def from_list(cls, values):
+        rollup = cls()
+        rollup.attempts, rollup.accepts, rollup.denies, rollup.timeouts, rollup.latency_sum, histogram = values[:6]
+        rollup.cancels = values[6] if len(values) > 6 else 0
+        rollup.histogram = {bucket: count for bucket, count in histogram}
+        return rollup
+
+class PageStore:
+    #Column name -> array typecode
+    REQUEST_COLUMNS = {
+        "start": 'd', #Time the page was requested
+        "site": 'H', #Index into self.sites
+        "kiosk": 'H', #Index into self.kiosks
+        "outcome": 'b', #OUTCOME_ACCEPT, OUTCOME_NO_HELP or OUTCOME_PENDING
+        "wait": 'd', #Seconds from request to accept, NaN otherwise
+        "attempts": 'H', #Badges paged
+        "tech": 'i', #Index of the badge that accepted, -1 otherwise
+    }
+    ATTEMPT_COLUMNS = {
+        "request": 'I', #Absolute request row
+        "tech": 'H', #Index into self.techs
+        "start": 'd', #Time the badge was paged
+        "outcome": 'b', #OUTCOME_ACCEPT, OUTCOME_DENY, OUTCOME_TIMEOUT, OUTCOME_CANCEL or OUTCOME_PENDING
+        "latency": 'd', #Seconds to accept or deny, NaN otherwise
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.through = 0 #Last analytics event applied, see AnalyticsLog.add_listener
+
+        self.requests = {name: array.array(code) for name, code in self.REQUEST_COLUMNS.items()}
+        self.attempts = {name: array.array(code) for name, code in self.ATTEMPT_COLUMNS.items()}
+        self.request_base = 0 #Absolute row of requests["start"][0], rows before it were pruned
+        self.attempt_base = 0
+        self.generation = 0 #Of the column files on disk
+
+        #Interned strings the index columns point into
+        self.techs = [] #client_ids
+        self.tech_index = {}
+        self.names = {} #client_id -> badge name last seen
+        self.sites = []
+        self.site_index = {}
+        self.kiosks = []
+        self.kiosk_index = {}
+
+        self.hourly = {} #tech index -> {hour: Rollup}, hour = epoch seconds // 3600
+        self.daily = {} #tech index -> {date ordinal: Rollup}, local dates
+        self.hourly_from = 0 #Earliest hour still rolled up, older hours are scanned
+
+        #Still in flight
+        self.open_requests = {} #request_id -> absolute request row
+        self.open_attempts = {} #(request_id, client_id) -> absolute attempt row
+
+        self.load()
+
+    # Apply one analytics event
+    def add(self, event):
+        with self._lock:
+            self.through = max(self.through, event["n"])
+            kind = event["e"]
+            if kind == EVENT_REQUEST:
+                self._add_request(event)
+            elif kind == EVENT_ATTEMPT:
+                self._add_attempt(event)
+            elif kind in (EVENT_ACCEPT, EVENT_DENY, EVENT_TIMEOUT, EVENT_CANCEL):
+                self._end_attempt(event)
+            elif kind == EVENT_NO_HELP:
+                row = self.open_requests.pop(event["r"], None)
+                if row is not None:
+                    self.requests["outcome"][row - self.request_base] = OUTCOME_NO_HELP
+
+    def _add_request(self, event):
+        self.open_requests[event["r"]] = self.request_base + len(self.requests["start"])
+        columns = self.requests
+        columns["start"].append(event["t"])
+        columns["site"].append(self._intern(event.get("s", ""), self.sites, self.site_index))
+        columns["kiosk"].append(self._intern(event.get("k", ""), self.kiosks, self.kiosk_index))
+        columns["outcome"].append(OUTCOME_PENDING)
+        columns["wait"].append(math.nan)
+        columns["attempts"].append(0)
+        columns["tech"].append(-1)
+
+    def _add_attempt(self, event):
+        requestRow = self.open_requests.get(event["r"])
+        if requestRow is None:
+            return #Request started before the history we have
+        client_id = event["c"]
+        tech = self._intern(client_id, self.techs, self.tech_index)
+        if "b" in event:
+            self.names[client_id] = event["b"]
+
+        self.open_attempts[(event["r"], client_id)] = self.attempt_base + len(self.attempts["start"])
+        columns = self.attempts
+        columns["request"].append(requestRow)
+        columns["tech"].append(tech)
+        columns["start"].append(event["t"])
+        columns["outcome"].append(OUTCOME_PENDING)
+        columns["latency"].append(math.nan)
+        self.requests["attempts"][requestRow - self.request_base] += 1
+
+        for rollup in self._rollups(tech, event["t"]):
+            rollup.attempts += 1
+
+    def _end_attempt(self, event):
+        row = self.open_attempts.pop((event["r"], event["c"]), None)
+        if row is None:
+            return
+        index = row - self.attempt_base
+        tech = self.attempts["tech"][index]
+        #Rollups are keyed by when the badge was paged, like the raw scan
+        rollups = self._rollups(tech, self.attempts["start"][index])
+
+        kind = event["e"]
+        if kind == EVENT_ACCEPT:
+            self.attempts["outcome"][index] = OUTCOME_ACCEPT
+            self.attempts["latency"][index] = event["l"]
+            for rollup in rollups:
+                rollup.add_accept(event["l"])
+
+            requestRow = self.open_requests.pop(event["r"], None)
+            if requestRow is not None:
+                requestIndex = requestRow - self.request_base
+                self.requests["outcome"][requestIndex] = OUTCOME_ACCEPT
+                self.requests["wait"][requestIndex] = event["t"] - self.requests["start"][requestIndex]
+                self.requests["tech"][requestIndex] = tech
+        elif kind == EVENT_DENY:
+            self.attempts["outcome"][index] = OUTCOME_DENY
+            self.attempts["latency"][index] = event["l"]
+            for rollup in rollups:
+                rollup.denies += 1
+        elif kind == EVENT_CANCEL:
+            self.attempts["outcome"][index] = OUTCOME_CANCEL
+            for rollup in rollups:
+                rollup.cancels += 1
+        else:
+            self.attempts["outcome"][index] = OUTCOME_TIMEOUT
+            for rollup in rollups:
+                rollup.timeouts += 1
+
+    def _intern(self, value, values, index):
+        position = index.get(value)
+        if position is None:
+            position = index[value] = len(values)
+            values.append(value)
+        return position
+
+    def _rollups(self, tech, when):
+        hour = int(when // 3600)
+        day = datetime.date.fromtimestamp(when).toordinal()
+        hourly = self.hourly.setdefault(tech, {})
+        daily = self.daily.setdefault(tech, {})
+        if hour not in hourly:
+            hourly[hour] = Rollup()
+        if day not in daily:
+            daily[day] = Rollup()
+        return hourly[hour], daily[day]
+
+    ###########
+    # QUERIES #
+    ###########
+
+    # client_id -> Rollup of the attempts made between since and until
+    def stats(self, since, until=None):
+        if until is None:
+            until = time.time()
+        merged = {}
+        with self._lock:
+            for rollupSet, key, start, end in self._segments(since, until):
+                if rollupSet is None:
+                    self._scan(merged, start, end)
+                    continue
+                for tech, rollups in rollupSet.items():
+                    rollup = rollups.get(key)
+                    if rollup is not None:
+                        self._merged(merged, tech).merge(rollup)
+            return {self.techs[tech]: rollup for tech, rollup in merged.items()}
+
+    # client_id -> seconds to accept at quantile q, for badges that accepted
+    def percentile(self, q, since, until=None):
+        result = {}
+        for client_id, rollup in self.stats(since, until).items():
+            value = rollup.percentile(q)
+            if value is not None:
+                result[client_id] = value
+        return result
+
+    def name(self, client_id):
+        return self.names.get(client_id, client_id)
+
+    # Copies of the raw columns for requests started between since and until,
+    # and the attempts made for them
+    def columns(self, since, until=None):
+        if until is None:
+            until = time.time()
+        with self._lock:
+            first = bisect.bisect_left(self.requests["start"], since)
+            last = bisect.bisect_left(self.requests["start"], until)
+            requests = {name: column[first:last] for name, column in self.requests.items()}
+
+            #Attempts of overlapping requests interleave, but none is made
+            #before its request started
+            firstRow = self.request_base + first
+            lastRow = self.request_base + last
+            rows = self.attempts["request"]
+            start = bisect.bisect_left(self.attempts["start"], since)
+            selected = [index for index in range(start, len(rows)) if firstRow <= rows[index] < lastRow]
+            attempts = {name: array.array(column.typecode, (column[index] for index in selected))
+                        for name, column in self.attempts.items()}
+            attempts["request"] = array.array('I', (row - firstRow for row in attempts["request"]))
+            return requests, attempts, list(self.techs)
+
+    #Splits since-until into whole days, whole hours and what's left over.
+    #Yields (rollups by tech, key, start, end), rollups None for a raw scan.
+    def _segments(self, since, until):
+        cursor = since
+        while cursor < until:
+            day = datetime.date.fromtimestamp(cursor)
+            nextDay = time.mktime((day + datetime.timedelta(days=1)).timetuple())
+            nextHour = (int(cursor // 3600) + 1) * 3600
+            if (cursor == time.mktime(day.timetuple())) and (nextDay <= until):
+                yield self.daily, day.toordinal(), cursor, nextDay
+                cursor = nextDay
+            elif (cursor % 3600 == 0) and (cursor + 3600 <= until) and (cursor // 3600 >= self.hourly_from):
+                yield self.hourly, int(cursor // 3600), cursor, cursor + 3600
+                cursor += 3600
+            else:
+                end = min(until, nextHour, nextDay)
+                yield None, None, cursor, end
+                cursor = end
+
+    def _scan(self, merged, start, end):
+        columns = self.attempts
+        first = bisect.bisect_left(columns["start"], start)
+        last = bisect.bisect_left(columns["start"], end)
+        for index in range(first, last):
+            rollup = self._merged(merged, columns["tech"][index])
+            rollup.attempts += 1
+            outcome = columns["outcome"][index]
+            if outcome == OUTCOME_ACCEPT:
+                rollup.add_accept(columns["latency"][index])
+            elif outcome == OUTCOME_DENY:
+                rollup.denies += 1
+            elif outcome == OUTCOME_TIMEOUT:
+                rollup.timeouts += 1
+            elif outcome == OUTCOME_CANCEL:
+                rollup.cancels += 1
+
+    def _merged(self, merged, tech):
+        rollup = merged.get(tech)
+        if rollup is None:
+            rollup = merged[tech] = Rollup()
+        return rollup
+
+    ###############
+    # PERSISTENCE #
+    ###############
+
+    # Write the store out, called by the analytics log. The columns go in raw
+    # native-order files that reports memory-map, see report.py. A checkpoint
+    # writes a new generation of them and only counts once meta.json is
+    # swapped in, so a crash part way through leaves the previous one intact.
+    def checkpoint(self):
+        with self._lock:
+            self._prune(time.time())
+            generation = self.generation + 1
+            requests = {name: column[:] for name, column in self.requests.items()}
+            attempts = {name: column[:] for name, column in self.attempts.items()}
+            meta = {
+                "generation": generation,
+                "through": self.through,
+                "rows": {"requests": len(requests["start"]), "attempts": len(attempts["start"])},
+                "typecodes": {"requests": self.REQUEST_COLUMNS, "attempts": self.ATTEMPT_COLUMNS},
+                "request_base": self.request_base,
+                "attempt_base": self.attempt_base,
+                "hourly_from": self.hourly_from,
+                "techs": list(self.techs),
+                "names": dict(self.names),
+                "sites": list(self.sites),
+                "kiosks": list(self.kiosks),
+                "hourly": [[tech, hour, rollup.to_list()] for tech, rollups in self.hourly.items() for hour, rollup in rollups.items()],
+                "daily": [[tech, day, rollup.to_list()] for tech, rollups in self.daily.items() for day, rollup in rollups.items()],
+                "open_requests": dict(self.open_requests),
+                "open_attempts": [[request_id, client_id, row] for (request_id, client_id), row in self.open_attempts.items()],
+            }
+
+        os.makedirs(self.path, exist_ok=True)
+        for table, columns in (("requests", requests), ("attempts", attempts)):
+            for name, column in columns.items():
+                with open(column_path(self.path, generation, table, name), 'wb') as file:
+                    column.tofile(file)
+                    file.flush()
+                    os.fsync(file.fileno())
+
+        metaPath = os.path.join(self.path, PAGE_STORE_META)
+        with open(metaPath + ".tmp", 'w') as file:
+            json.dump(meta, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(metaPath + ".tmp", metaPath)
+        self.generation = generation
+
+        #The previous generation's columns are no longer referenced. On Windows
+        #a report still mapping one keeps it until the next checkpoint.
+        for fileName in os.listdir(self.path):
+            if fileName.endswith(".bin") and not fileName.startswith(f"{generation}-"):
+                try:
+                    os.remove(os.path.join(self.path, fileName))
+                except OSError:
+                    pass
+        if DEBUG_TIMESERIES:
+            print(f"Time series -- saved {meta['rows']['requests']} requests through event {self.through}")
+
+    def load(self):
+        meta = read_meta(self.path)
+        if meta is None:
+            return
+
+        self.generation = meta["generation"]
+        self.through = meta["through"]
+        self.request_base = meta["request_base"]
+        self.attempt_base = meta["attempt_base"]
+        self.hourly_from = meta["hourly_from"]
+        for table, columns in (("requests", self.requests), ("attempts", self.attempts)):
+            for name, column in columns.items():
+                with open(column_path(self.path, self.generation, table, name), 'rb') as file:
+                    column.fromfile(file, meta["rows"][table])
+
+        self.techs = meta["techs"]
+        self.tech_index = {client_id: tech for tech, client_id in enumerate(self.techs)}
+        self.names = meta["names"]
+        self.sites = meta["sites"]
+        self.site_index = {site: index for index, site in enumerate(self.sites)}
+        self.kiosks = meta["kiosks"]
+        self.kiosk_index = {kiosk: index for index, kiosk in enumerate(self.kiosks)}
+
+        for tech, hour, values in meta["hourly"]:
+            self.hourly.setdefault(tech, {})[hour] = Rollup.from_list(values)
+        for tech, day, values in meta["daily"]:
+            self.daily.setdefault(tech, {})[day] = Rollup.from_list(values)
+        self.open_requests = meta["open_requests"]
+        self.open_attempts = {(request_id, client_id): row for request_id, client_id, row in meta["open_attempts"]}
+
+    #Drop raw records and hourly rollups past retention, and requests that
+    #will never hear back
+    def _prune(self, now):
+        horizon = now - PAGE_STORE_RAW_DAYS * 86400
+
+        requestCut = bisect.bisect_left(self.requests["start"], horizon)
+        if requestCut:
+            for column in self.requests.values():
+                del column[:requestCut]
+            self.request_base += requestCut
+        attemptCut = bisect.bisect_left(self.attempts["start"], horizon)
+        if attemptCut:
+            for column in self.attempts.values():
+                del column[:attemptCut]
+            self.attempt_base += attemptCut
+
+        self.hourly_from = int((now - PAGE_STORE_HOURLY_DAYS * 86400) // 3600)
+        for rollups in self.hourly.values():
+            for hour in [hour for hour in rollups if hour < self.hourly_from]:
+                del rollups[hour]
+
+        staleRow = self.request_base + bisect.bisect_left(self.requests["start"], now - PAGE_STORE_OPEN_LIMIT)
+        self.open_requests = {request_id: row for request_id, row in self.open_requests.items() if row >= staleRow}
+        self.open_attempts = {key: row for key, row in self.open_attempts.items()
+                              if (row >= self.attempt_base) and (key[0] in self.open_requests)}
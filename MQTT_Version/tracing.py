@@ -0,0 +1,187 @@
+#Page tracing - Patron Handler Service
+#Follows each page request through the service: every state it passes
+#through, every badge paged (from the page going out to its answer, timeout
+#or cancel), every publish from hand-off to the socket and every answer from
+#arriving off the socket to being handled. Each span is timestamped relative
+#to the request, so a long wait shows where the time went.
+#
+#Finished traces are written, once the publishes they made have settled, as
+#JSON lines to a rotating file from a logging thread. Each trace is written
+#once; anything it records afterwards is dropped. Tracing is off unless
+#TRACE_PAGES is set; while off every request gets NULL_TRACE, whose methods
+#do nothing.
+#
+#Usage: python tracing.py [-n COUNT] [--file traces.jsonl]
+#prints the slowest traces in the file and its rotated backups.
+
+import argparse
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+TRACE_PAGES = False
+TRACE_FILE = "traces.jsonl"
+TRACE_MAX_BYTES = 5 * 1024 * 1024 #Size a trace file reaches before it is rotated
+TRACE_BACKUPS = 3 #Rotated files kept, traces.jsonl.1 is the newest
+
+def trace_path(name):
+    return f"traces-{name}.jsonl" if name else TRACE_FILE
+
+class Trace:
+    __slots__ = ("request_id", "attrs", "start", "spans", "open", "publishing", "record", "written")
+
+    def __init__(self, request_id, attrs):
+        self.request_id = request_id
+        self.attrs = attrs
+        self.start = time.time()
+        self.spans = []
+        self.open = {} #(name, key) -> (start, attrs)
+        self.publishing = 0 #Publish futures not yet settled
+        self.record = None #Set by finish(), written once publishing is 0
+        self.written = False
+
+    # A span that already happened, start and end are time.time() values
+    def span(self, name, start, end, **attrs):
+        attrs.update(n=name, o=round(start - self.start, 4), d=round(end - start, 4))
+        self.spans.append(attrs)
+
+    # Open a span, closed by end() with the same name and key
+    def begin(self, name, key=None, **attrs):
+        self.open[(name, key)] = (time.time(), attrs)
+
+    def end(self, name, key=None, **attrs):
+        entry = self.open.pop((name, key), None)
+        if entry is None:
+            return
+        start, beginAttrs = entry
+        beginAttrs.update(attrs)
+        self.span(name, start, time.time(), **beginAttrs)
+
+    # A publish future, the span ends when the message reaches the socket. A
+    # trace finished before its publishes settle (the cancels sent on an
+    # accept) is written once they have.
+    def publish(self, future, **attrs):
+        if future is None:
+            return
+        start = time.time()
+        self.publishing += 1
+        def published(future):
+            failed = future.cancelled() or (future.exception() is not None)
+            self.span("publish", start, time.time(), failed=failed, **attrs)
+            self.publishing -= 1
+            if self.record is not None and self.publishing == 0:
+                self._write()
+        future.add_done_callback(published)
+
+    # Close what is still open and write the trace out, or have the last
+    # publish still in flight write it
+    def finish(self, **attrs):
+        for name, key in list(self.open):
+            self.end(name, key, unfinished=True)
+        end = time.time()
+        self.record = {"id": self.request_id, "start": self.start, "duration": round(end - self.start, 4)}
+        self.record.update(self.attrs)
+        self.record.update(attrs)
+        if self.publishing == 0:
+            self._write()
+
+    def _write(self):
+        if self.written:
+            return
+        self.written = True
+        self.record["spans"] = self.spans
+        _logger.info(json.dumps(self.record, separators=(',', ':'), default=str))
+
+class NullTrace:
+    __slots__ = ()
+
+    def span(self, name, start, end, **attrs):
+        pass
+
+    def begin(self, name, key=None, **attrs):
+        pass
+
+    def end(self, name, key=None, **attrs):
+        pass
+
+    def publish(self, future, **attrs):
+        pass
+
+    def finish(self, **attrs):
+        pass
+
+NULL_TRACE = NullTrace()
+
+_logger = logging.getLogger("patron.traces")
+_logger.propagate = False
+_listener = None
+
+# Start writing traces to path from a background thread
+def enable(path=TRACE_FILE):
+    global _listener
+    if _listener is not None:
+        return
+    records = queue.SimpleQueue()
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    _logger.addHandler(logging.handlers.QueueHandler(records))
+    _logger.setLevel(logging.INFO)
+
+def enabled():
+    return _listener is not None
+
+# Trace for a new page request, NULL_TRACE while tracing is off
+def start_trace(request_id, **attrs):
+    if _listener is None:
+        return NULL_TRACE
+    return Trace(request_id, attrs)
+
+#######
+# CLI #
+#######
+
+def read_traces(path):
+    traces = []
+    for backup in range(TRACE_BACKUPS, -1, -1):
+        filePath = f"{path}.{backup}" if backup else path
+        if not os.path.exists(filePath):
+            continue
+        with open(filePath, 'r') as file:
+            for line in file:
+                try:
+                    traces.append(json.loads(line))
+                except ValueError:
+                    continue #Torn write at the end of the file
+    return traces
+
+def format_trace(trace):
+    started = time.strftime("%b %d %H:%M:%S", time.localtime(trace["start"]))
+    details = " ".join(f"{key}={value}" for key, value in trace.items() if key not in ("id", "start", "duration", "spans"))
+    lines = [f"{trace['id']}  {trace['duration']:.3f}s  {started}  {details}"]
+    for span in sorted(trace["spans"], key=lambda span: span["o"]):
+        extra = " ".join(f"{key}={value}" for key, value in span.items() if key not in ("n", "o", "d"))
+        lines.append(f"  +{span['o']:8.3f}s {span['d']:8.3f}s  {span['n']:<10} {extra}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the slowest page traces")
+    parser.add_argument("-n", "--count", type=int, default=10, help="traces to print")
+    parser.add_argument("--file", default=TRACE_FILE, help="trace file, its rotated backups are read too")
+    args = parser.parse_args()
+
+    traces = read_traces(args.file)
+    if not traces:
+        print(f"No traces in {args.file}, set TRACE_PAGES in tracing.py to record them")
+        return
+    traces.sort(key=lambda trace: trace["duration"], reverse=True)
+    print(f"{min(args.count, len(traces))} slowest of {len(traces)} traces\n")
+    for trace in traces[:args.count]:
+        print(format_trace(trace) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#Client view model - Patron Handler Service
+#The service thread records what each badge's button should look like here
+#instead of queueing a GUI task per message. The GUI keeps the state it last
+#rendered and, once per frame, only touches the buttons whose state actually
+#changed. Any number of updates to a badge between frames collapse into one.
+
+import threading
+
+class ClientView:
+    __slots__ = ("record", "name", "status")
+
+    def __init__(self, record, name, status):
+        self.record = record #For the detail panel when the button is clicked
+        self.name = name
+        self.status = status
+
+    def same(self, other):
+        return (other is not None) and (self.name == other.name) and (self.status == other.status)
+
+class ClientViewModel:
+    #notify is called when the first change since the GUI last looked comes in
+    def __init__(self, notify=None):
+        self.notify = notify
+        self._lock = threading.Lock()
+        self._desired = {} #client_id -> ClientView, None once removed
+        self._dirty = {} #client_ids changed since the GUI last looked, in order
+        self.rendered = {} #client_id -> ClientView on screen, GUI thread only
+
+    # Service side: the badge's button should show status
+    def update(self, record, status):
+        with self._lock:
+            wasClean = not self._dirty
+            self._desired[record.client_id] = ClientView(record, record.name, status)
+            self._dirty[record.client_id] = None
+        if wasClean and self.notify is not None:
+            self.notify()
+
+    # Service side: the badge's button should go
+    def remove(self, client_id):
+        with self._lock:
+            wasClean = not self._dirty
+            self._desired[client_id] = None
+            self._dirty[client_id] = None
+        if wasClean and self.notify is not None:
+            self.notify()
+
+    def pending(self):
+        return len(self._dirty)
+
+    # GUI side: up to limit (client_id, view) pairs that differ from what is on
+    # screen, view is None for buttons to remove. They count as rendered.
+    def changes(self, limit):
+        changed = []
+        with self._lock:
+            while self._dirty and len(changed) < limit:
+                client_id = next(iter(self._dirty))
+                del self._dirty[client_id]
+                view = self._desired.get(client_id)
+                if view is None:
+                    self._desired.pop(client_id, None)
+                    if client_id in self.rendered:
+                        changed.append((client_id, None))
+                elif not view.same(self.rendered.get(client_id)):
+                    changed.append((client_id, view))
+
+        for client_id, view in changed:
+            if view is None:
+                del self.rendered[client_id]
+            else:
+                self.rendered[client_id] = view
+        return changed